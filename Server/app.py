@@ -1,17 +1,34 @@
-from flask import Flask, request, session, make_response, send_from_directory
+from flask import Flask, request, session, make_response, send_from_directory, abort
 from flask_cors import CORS
 from flask_migrate import Migrate
 from flask_restful import Api, Resource
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
 import os
-import requests
+import json
+import base64
+import click
+import time
+from sqlalchemy.orm import joinedload, selectinload, load_only
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from extensions import db, bcrypt
+from cache import ResponseCache, create_cache_backend
+from idempotency import Idempotency, create_idempotency_store
+from serialization import FastJSONProvider, serializer
+from compression import ResponseCompressor
+from exports import EXPORT_FORMATS, export_response
+from jobs import JobQueue, JobWorker, utcnow
+from images import DEFAULT_RENDITION, is_rendition, new_image_name, rendition_filenames, rendition_urls, save_renditions
+from daraja import DarajaClient, DarajaError
+from requests import RequestException
 
 # Create uploads folder
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Originals kept until the job worker has stored their remaining renditions (not served, /uploads/ only serves top-level files)
+PENDING_UPLOAD_FOLDER = os.path.join(UPLOAD_FOLDER, 'pending')
+os.makedirs(PENDING_UPLOAD_FOLDER, exist_ok=True)
 
 #loads the variables from the .env file
 load_dotenv()
@@ -28,7 +45,8 @@ else:
     # Fallback to local SQLite for development
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///app.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.json.compact = False
+#Compact JSON responses, encoded with orjson when it is installed
+app.json = FastJSONProvider(app)
 app.secret_key = os.getenv('SECRET_KEY', 'dev-secret-key')
 
 # Session cookie configuration for cross-origin requests (production)
@@ -47,35 +65,506 @@ api = Api(app)
 migrate = Migrate(app,db)
 #Initialize bcrypt with app
 bcrypt.init_app(app)
+#Response cache for public catalogue endpoints, invalidated when the tables behind them change
+#Use the sqlite backend under gunicorn so all workers share entries and invalidations
+response_cache = ResponseCache(
+    create_cache_backend(
+        os.getenv('RESPONSE_CACHE_BACKEND', 'memory'),
+        os.getenv('RESPONSE_CACHE_PATH', os.path.join(app.instance_path, 'response_cache.db')),
+        int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 1000))
+    ),
+    ttl=int(os.getenv('RESPONSE_CACHE_TTL', 60)),
+    scopes={'menu_items': 'restaurant_id'}
+)
+response_cache.watch(db.session)
+#Idempotency-Key support so client retries of order and payment creation are not applied twice
+#Use the sqlite backend under gunicorn so a retry reaching another worker still finds the key
+idempotency = Idempotency(
+    create_idempotency_store(
+        os.getenv('IDEMPOTENCY_BACKEND', 'memory'),
+        os.getenv('IDEMPOTENCY_PATH', os.path.join(app.instance_path, 'idempotency.db')),
+        int(os.getenv('IDEMPOTENCY_MAX_ENTRIES', 10000))
+    ),
+    ttl=int(os.getenv('IDEMPOTENCY_TTL', 86400))
+)
+#Opt-in gzip/brotli compression for responses above RESPONSE_COMPRESSION_MIN_SIZE bytes
+if os.getenv('RESPONSE_COMPRESSION', '').lower() in ('1', 'true', 'yes'):
+    ResponseCompressor(
+        min_size=int(os.getenv('RESPONSE_COMPRESSION_MIN_SIZE', 1024)),
+        gzip_level=int(os.getenv('RESPONSE_COMPRESSION_GZIP_LEVEL', 6)),
+        brotli_quality=int(os.getenv('RESPONSE_COMPRESSION_BROTLI_QUALITY', 4))
+    ).init_app(app)
 
 # Import models after db and bcrypt are initialized to avoid circular import
-from models import Restaurant, DeliveryAgent, Customer, MenuItem, Order, Payment, RestaurantReview, DeliveryReview, Admin, OrderMenuItem
-
-# Helper function to update average rating for a restaurant
-def update_restaurant_rating(restaurant_id):
-    """Calculate and update the average rating for a restaurant based on all its reviews"""
-    if not restaurant_id:
+from models import Restaurant, DeliveryAgent, Customer, MenuItem, Order, Payment, RestaurantReview, DeliveryReview, Admin, OrderMenuItem, RestaurantDailyStats, Job, MpesaCallbackEntry, StkRequest
+
+#Background jobs: handlers enqueue follow-up work that runs after the response is sent
+#Each web process runs JOBS_WORKER_THREADS worker threads (default 1), so queued work such as M-Pesa callbacks
+#is applied with a plain gunicorn deploy; set it to 0 only when `flask jobs-worker` runs separately
+job_queue = JobQueue(Job)
+job_worker = JobWorker(app, job_queue, threads=int(os.getenv('JOBS_WORKER_THREADS', 1)))
+
+@app.before_request
+def start_job_worker():
+    # Started by the first request so CLI commands and migrations never spawn workers
+    job_worker.start()
+
+@app.cli.command('jobs-worker')
+@click.option('--threads', default=2, show_default=True, help='Number of worker threads')
+@click.option('--burst', is_flag=True, help='Run the jobs that are due, then exit')
+def jobs_worker_command(threads, burst):
+    """Run queued background jobs."""
+    if burst:
+        print(f'Ran {JobWorker(app, job_queue).run_until_empty()} jobs')
         return
-    reviews = RestaurantReview.query.filter_by(restaurant_id=restaurant_id).all()
-    if reviews:
-        avg_rating = sum(r.rating for r in reviews) / len(reviews)
-        restaurant = Restaurant.query.get(restaurant_id)
-        if restaurant:
-            restaurant.rating = round(avg_rating, 1)
-            db.session.commit()
-
-# Helper function to update average rating for a delivery agent
-def update_delivery_agent_rating(agent_id):
-    """Calculate and update the average rating for a delivery agent based on all their reviews"""
-    if not agent_id:
+    worker = JobWorker(app, job_queue, threads=threads)
+    worker.start()
+    print(f'Job worker running with {threads} threads, press CTRL+C to stop')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        worker.stop()
+
+#M-Pesa (Daraja) client shared by all requests, so the OAuth token and connections are reused
+#Point MPESA_BASE_URL at a local stub server to test without Safaricom
+daraja = DarajaClient(
+    os.getenv('MPESA_BASE_URL', 'https://sandbox.safaricom.co.ke'),
+    os.getenv('MPESA_CONSUMER_KEY', ''),
+    os.getenv('MPESA_CONSUMER_SECRET', ''),
+    os.getenv('MPESA_SHORTCODE', ''),
+    os.getenv('MPESA_PASSKEY', ''),
+    os.getenv('MPESA_CALLBACK_URL', ''),
+    connect_timeout=float(os.getenv('MPESA_CONNECT_TIMEOUT', 3.05)),
+    read_timeout=float(os.getenv('MPESA_READ_TIMEOUT', 10))
+)
+#Status queries per second the STK reconciler may send, keep it under the Daraja app's rate limit
+MPESA_QUERY_RATE = float(os.getenv('MPESA_QUERY_RATE', 2))
+
+# Serializers for the partial views of models returned by the resources below
+restaurant_details = serializer('id', 'name', 'email', 'address', 'contact', 'rating', 'logo', 'paybill_number', 'bio')
+restaurant_contact = serializer('id', 'name', 'logo', 'contact', 'address')
+restaurant_summary = serializer('id', 'name', 'logo')
+leaderboard_restaurant = serializer('id', 'name', 'email', 'address', 'contact', 'rating', 'logo')
+homepage_restaurant = serializer('id', 'name', 'rating', 'logo', 'address', 'bio')
+homepage_menu_item = serializer('id', 'name', 'unit_price', 'image', 'description', 'restaurant_id')
+# Customers and delivery agents embedded in orders
+person_summary = serializer('id', 'name', 'image', 'contact')
+order_line_menu_item = serializer('id', 'name', 'unit_price', 'image')
+# Fields shared by restaurant and delivery reviews in a customer's combined review list
+review_summary = serializer('id', 'comment', 'rating', 'created_at')
+
+def order_lines(order):
+    """Serialize an order's line items as their menu items with quantities"""
+    return [
+        {**order_line_menu_item(line.menu_item), 'quantity': line.quantity}
+        for line in order.order_menu_items
+    ]
+
+# Helper function to adjust the running rating totals of a restaurant or delivery agent
+def adjust_rating(model, target_id, rating_delta, count_delta):
+    """Apply a review change to model's rating_sum/rating_count and average rating in the current transaction"""
+    if not target_id:
         return
-    reviews = DeliveryReview.query.filter_by(delivery_agent_id=agent_id).all()
-    if reviews:
-        avg_rating = sum(r.rating for r in reviews) / len(reviews)
-        agent = DeliveryAgent.query.get(agent_id)
-        if agent:
-            agent.rating = round(avg_rating, 1)
-            db.session.commit()
+    new_sum = model.rating_sum + rating_delta
+    new_count = model.rating_count + count_delta
+    # A single UPDATE keeps concurrent review writes from overwriting each other's totals
+    model.query.filter(model.id == target_id).update({
+        model.rating_sum: new_sum,
+        model.rating_count: new_count,
+        model.rating: db.case(
+            (new_count > 0, db.func.round(db.cast(new_sum / new_count, db.Numeric), 1)),
+            else_=model.rating
+        )
+    }, synchronize_session=False)
+
+# Helper function to rebuild rating totals from the review tables
+def rebuild_ratings():
+    """Recompute rating_sum, rating_count and rating for every restaurant and delivery agent in one statement each"""
+    for model, review_model, foreign_key in (
+        (Restaurant, RestaurantReview, RestaurantReview.restaurant_id),
+        (DeliveryAgent, DeliveryReview, DeliveryReview.delivery_agent_id),
+    ):
+        review_sum = db.select(db.func.coalesce(db.func.sum(review_model.rating), 0)).where(
+            foreign_key == model.id
+        ).scalar_subquery()
+        review_count = db.select(db.func.count(review_model.id)).where(
+            foreign_key == model.id
+        ).scalar_subquery()
+        db.session.execute(db.update(model).values({
+            model.rating_sum: review_sum,
+            model.rating_count: review_count,
+            model.rating: db.case(
+                (review_count > 0, db.func.round(db.cast(review_sum / review_count, db.Numeric), 1)),
+                else_=model.rating
+            )
+        }).execution_options(synchronize_session=False))
+    db.session.commit()
+
+@app.cli.command('rebuild-ratings')
+def rebuild_ratings_command():
+    """Rebuild restaurant and delivery agent rating totals from their reviews."""
+    rebuild_ratings()
+    print('Ratings rebuilt')
+
+# Helper function to express a time the way the database stores it
+def local_time(moment):
+    """Return moment in Africa/Nairobi time. Timestamps are stored as naive Nairobi wall-clock times,
+    so naive datetimes (e.g. read back from the database) are taken to be Nairobi times already."""
+    timezone = pytz.timezone('Africa/Nairobi')
+    if moment.tzinfo is None:
+        return timezone.localize(moment)
+    return moment.astimezone(timezone)
+
+# Helper function to add to a restaurant's daily rollup
+def adjust_daily_stats(restaurant_id, moment, **deltas):
+    """Add deltas to restaurant_id's rollup row for the Nairobi day of moment in the current transaction, creating the row if needed"""
+    if restaurant_id is None or moment is None:
+        return
+    insert = postgresql_insert if db.engine.dialect.name == 'postgresql' else sqlite_insert
+    statement = insert(RestaurantDailyStats).values(restaurant_id=restaurant_id, day=local_time(moment).date(), **deltas)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['restaurant_id', 'day'],
+        set_={name: getattr(RestaurantDailyStats, name) + statement.excluded[name] for name in deltas}
+    ))
+
+def adjust_order_stats(order, items_sold, sign=1):
+    """Count a placed order and its items in the rollup (sign=-1 takes them back out)"""
+    adjust_daily_stats(order.restaurant_id, order.created_at, order_count=sign, items_sold=sign * items_sold)
+
+def adjust_payment_stats(payment, sign=1):
+    """Count a payment in the rollup (sign=-1 takes it back out)"""
+    adjust_daily_stats(payment.restaurant_id, payment.created_at, paid_order_count=sign, revenue=sign * float(payment.amount))
+
+def adjust_delivery_stats(order, delivery_time, sign=1):
+    """Count an order delivered at delivery_time in the rollup (sign=-1 takes it back out)"""
+    seconds = (local_time(delivery_time) - local_time(order.created_at)).total_seconds()
+    adjust_daily_stats(order.restaurant_id, delivery_time, delivered_count=sign, delivery_seconds=sign * seconds)
+
+def remove_order_stats(order):
+    """Take an order that is being deleted, its items and its delivery back out of the rollup"""
+    adjust_order_stats(order, sum(line.quantity for line in order.order_menu_items), sign=-1)
+    if order.delivery_time:
+        adjust_delivery_stats(order, order.delivery_time, sign=-1)
+
+# Helper function to record an order's payment
+def settle_order(order, amount, method, transaction_id=None):
+    """Mark order paid and add its Payment in the current transaction. Returns the Payment, or None if it was already paid.
+
+    Paying is one conditional UPDATE, so of any number of concurrent settlements of an order exactly one
+    succeeds and the rest see an already paid order instead of failing on the payments.order_id constraint.
+    """
+    paid = db.session.execute(
+        db.update(Order).where(Order.id == order.id, Order.payment_status.isnot(True)).values(payment_status=True)
+    )
+    if paid.rowcount != 1:
+        return None
+    payment = Payment(
+        order_id=order.id,
+        customer_id=order.customer_id,
+        restaurant_id=order.restaurant_id,
+        amount=amount,
+        method=method,
+        transaction_id=transaction_id
+    )
+    db.session.add(payment)
+    db.session.flush()
+    adjust_payment_stats(payment)
+    return payment
+
+# Helper function to rebuild the daily rollup from orders and payments
+def rebuild_daily_stats(since=None, until=None):
+    """Recompute the rollup rows for days in [since, until] (every day when omitted) from the source tables"""
+    def day_of(column):
+        return db.func.date(column, type_=db.Date)
+    
+    def window(column):
+        return date_range_filters(
+            column,
+            datetime.combine(since, datetime.min.time()) if since else None,
+            datetime.combine(until + timedelta(days=1), datetime.min.time()) if until else None
+        )
+    
+    if db.engine.dialect.name == 'postgresql':
+        delivery_seconds = db.func.extract('epoch', Order.delivery_time - Order.created_at)
+    else:
+        delivery_seconds = (db.func.julianday(Order.delivery_time) - db.func.julianday(Order.created_at)) * 86400
+    
+    line_items = db.select(
+        OrderMenuItem.order_id, db.func.sum(OrderMenuItem.quantity).label('quantity')
+    ).group_by(OrderMenuItem.order_id).subquery()
+    # (rollup columns, query returning restaurant_id, day and those columns' values)
+    sources = [
+        (('order_count', 'items_sold'), db.select(
+            Order.restaurant_id, day_of(Order.created_at),
+            db.func.count(Order.id), db.func.coalesce(db.func.sum(line_items.c.quantity), 0)
+        ).outerjoin(line_items, line_items.c.order_id == Order.id).where(*window(Order.created_at))),
+        (('paid_order_count', 'revenue'), db.select(
+            Payment.restaurant_id, day_of(Payment.created_at),
+            db.func.count(Payment.id), db.func.sum(Payment.amount)
+        ).where(*window(Payment.created_at))),
+        (('delivered_count', 'delivery_seconds'), db.select(
+            Order.restaurant_id, day_of(Order.delivery_time),
+            db.func.count(Order.id), db.func.sum(delivery_seconds)
+        ).where(Order.delivery_time.isnot(None), *window(Order.delivery_time))),
+    ]
+    
+    rows = {}
+    for metrics, statement in sources:
+        restaurant_id, day = statement.selected_columns[0], statement.selected_columns[1]
+        for restaurant_id_value, day_value, *values in db.session.execute(
+            statement.where(restaurant_id.isnot(None)).group_by(restaurant_id, day)
+        ):
+            row = rows.setdefault((restaurant_id_value, day_value), {'restaurant_id': restaurant_id_value, 'day': day_value})
+            row.update(zip(metrics, values))
+    
+    RestaurantDailyStats.query.filter(
+        *date_range_filters(RestaurantDailyStats.day, since, until + timedelta(days=1) if until else None)
+    ).delete(synchronize_session=False)
+    if rows:
+        db.session.execute(db.insert(RestaurantDailyStats), list(rows.values()))
+    db.session.commit()
+
+@app.cli.command('rebuild-daily-stats')
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']), help='First day to rebuild (default: all history)')
+@click.option('--until', type=click.DateTime(formats=['%Y-%m-%d']), help='Last day to rebuild (default: all history)')
+def rebuild_daily_stats_command(since, until):
+    """Rebuild the per-restaurant daily rollup from orders and payments."""
+    rebuild_daily_stats(since.date() if since else None, until.date() if until else None)
+    print('Daily stats rebuilt')
+
+# Longest window a daily stats request may cover
+MAX_STATS_DAYS = 366
+
+# Helper function to read the since/until day window for daily stats
+def parse_day_range():
+    """Parse the since/until query parameters as days (default: the last 30 days), raising ValueError on bad input"""
+    since = request.args.get('since')
+    until = request.args.get('until')
+    until = datetime.fromisoformat(until).date() if until else datetime.now(pytz.timezone('Africa/Nairobi')).date()
+    since = datetime.fromisoformat(since).date() if since else until - timedelta(days=29)
+    if since > until:
+        raise ValueError('since must not be after until')
+    if (until - since).days >= MAX_STATS_DAYS:
+        raise ValueError(f'at most {MAX_STATS_DAYS} days can be requested at once')
+    return since, until
+
+# Helper function to read a daily time series from the rollup
+def daily_stats_series(since, until, restaurant_id=None):
+    """Return one entry per day in [since, until], summed over every restaurant unless restaurant_id is given.
+    Only the rollup rows in the window are read, however much order history there is."""
+    metrics = ['order_count', 'items_sold', 'paid_order_count', 'revenue', 'delivered_count', 'delivery_seconds']
+    query = db.select(
+        RestaurantDailyStats.day,
+        *[db.func.sum(getattr(RestaurantDailyStats, metric)) for metric in metrics]
+    ).where(
+        RestaurantDailyStats.day >= since,
+        RestaurantDailyStats.day <= until
+    ).group_by(RestaurantDailyStats.day)
+    if restaurant_id is not None:
+        query = query.where(RestaurantDailyStats.restaurant_id == restaurant_id)
+    totals = {day: values for day, *values in db.session.execute(query)}
+    
+    # Days without activity have no rollup row, report them as zeros
+    series = []
+    for offset in range((until - since).days + 1):
+        day = since + timedelta(days=offset)
+        values = totals.get(day, [0] * len(metrics))
+        series.append(RestaurantDailyStats(day=day, **dict(zip(metrics, values))).to_dict())
+    return series
+
+# Helper function to build an order query with its related records loaded in bulk
+def order_query(*relationships):
+    """Return an Order query that bulk loads line items, their menu items and the given Order relationships"""
+    return Order.query.options(
+        selectinload(Order.order_menu_items).joinedload(OrderMenuItem.menu_item),
+        *[joinedload(relationship) for relationship in relationships]
+    )
+
+# Helper function to validate cart lines against a restaurant's menu
+def load_cart(restaurant_id, menu_items_data, ordered_ids=()):
+    """Merge cart lines into {menu_item_id: quantity} and load their menu items with a single IN query.
+    Items in ordered_ids are already on the order and may stay on it even if no longer available.
+    Returns (quantities, menu_items, error) where error describes the first invalid line, if any."""
+    quantities = {}
+    for item_data in menu_items_data:
+        try:
+            menu_item_id = int(item_data.get('id'))
+            quantity = int(item_data.get('quantity', 1))
+        except (AttributeError, TypeError, ValueError):
+            return None, None, 'Each menu item needs a numeric id and quantity'
+        if quantity < 1:
+            return None, None, f'Invalid quantity for menu item {menu_item_id}'
+        quantities[menu_item_id] = quantities.get(menu_item_id, 0) + quantity
+    
+    menu_items = {
+        m.id: m for m in MenuItem.query.filter(MenuItem.id.in_(quantities)).all()
+    }
+    for menu_item_id in quantities:
+        menu_item = menu_items.get(menu_item_id)
+        if not menu_item or menu_item.restaurant_id != int(restaurant_id):
+            return None, None, f'Menu item {menu_item_id} is not on this restaurant\'s menu'
+        if not menu_item.availability and menu_item_id not in ordered_ids:
+            return None, None, f'Menu item {menu_item_id} is not available'
+    return quantities, menu_items, None
+
+# Helper function to read the optional since/until query parameters
+def parse_date_range():
+    """Parse the since/until ISO date query parameters, raising ValueError on bad input"""
+    since = request.args.get('since')
+    until = request.args.get('until')
+    return (
+        datetime.fromisoformat(since.replace('Z', '+00:00')) if since else None,
+        datetime.fromisoformat(until.replace('Z', '+00:00')) if until else None
+    )
+
+# Helper function to turn a since/until pair into filters on a datetime column
+def date_range_filters(column, since, until):
+    """Return the SQL filters restricting column to the [since, until) window"""
+    filters = []
+    if since:
+        filters.append(column >= since)
+    if until:
+        filters.append(column < until)
+    return filters
+
+# Keyset pagination for list endpoints (?limit=&after=)
+DEFAULT_PAGE_LIMIT = 50
+MAX_PAGE_LIMIT = 200
+
+def pagination_requested():
+    """Return True when the request asks for a paginated listing"""
+    return 'limit' in request.args or 'after' in request.args
+
+def paginate(query, model):
+    """Apply ?limit=&after= keyset pagination ordered by model's (created_at, id) and return (rows, next_cursor).
+    Without those parameters every row is returned and next_cursor is None."""
+    if not pagination_requested():
+        return query.all(), None
+    
+    limit = request.args.get('limit', DEFAULT_PAGE_LIMIT, type=int)
+    limit = max(1, min(limit, MAX_PAGE_LIMIT))
+    keys = [model.created_at, model.id] if hasattr(model, 'created_at') else [model.id]
+    
+    after = request.args.get('after')
+    if after:
+        try:
+            values = json.loads(base64.urlsafe_b64decode(after.encode()))
+            if not isinstance(values, list) or len(values) != len(keys):
+                raise ValueError('cursor does not match this listing')
+            if len(keys) == 2:
+                values = [datetime.fromisoformat(values[0]), int(values[1])]
+            else:
+                values = [int(values[0])]
+        except (ValueError, TypeError) as e:
+            abort(make_response({'error': f'Invalid cursor: {str(e)}'}, 400))
+        query = query.filter(db.tuple_(*keys) > db.tuple_(*values))
+    
+    # Fetch one extra row to learn whether another page exists
+    rows = query.order_by(*keys).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    
+    rows = rows[:limit]
+    last = rows[-1] if isinstance(rows[-1], model) else rows[-1][0]
+    values = [last.created_at.isoformat(), last.id] if len(keys) == 2 else [last.id]
+    next_cursor = base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+    return rows, next_cursor
+
+def page_response(items, next_cursor):
+    """Wrap a listing with its next_cursor when pagination was requested, otherwise return the plain list"""
+    if pagination_requested():
+        return make_response({'items': items, 'next_cursor': next_cursor}, 200)
+    return make_response(items, 200)
+
+# Helper function to embed a related record in order listings
+def order_embed(relationship, serialize):
+    """Return (loader option, renderer) that joins only the columns serialize reads and renders None when unset"""
+    model = relationship.property.mapper.class_
+    loader = joinedload(relationship).load_only(*[getattr(model, field) for field in serialize.fields])
+    
+    def render(order):
+        related = getattr(order, relationship.key)
+        return serialize(related) if related is not None else None
+    return loader, render
+
+# Records that ?include= can embed in order listings
+ORDER_EMBEDS = {
+    'customer': order_embed(Order.customer, person_summary),
+    'delivery_agent': order_embed(Order.delivery_agent, person_summary),
+    'restaurant': order_embed(Order.restaurant, restaurant_summary),
+    'menu_items': (
+        selectinload(Order.order_menu_items).joinedload(OrderMenuItem.menu_item).load_only(
+            *[getattr(MenuItem, field) for field in order_line_menu_item.fields]
+        ),
+        order_lines
+    ),
+}
+
+# Helper function to read a comma separated list of names from the query string
+def names_arg(name, allowed, default):
+    """Return the names listed in ?<name>= (default when absent), aborting with 400 on names not in allowed"""
+    value = request.args.get(name)
+    if value is None:
+        return list(default)
+    names = [n.strip() for n in value.split(',') if n.strip()]
+    unknown = [n for n in names if n not in allowed]
+    if unknown:
+        abort(make_response({'error': f'Unknown {name}: {", ".join(unknown)}. Allowed: {", ".join(allowed)}'}, 400))
+    return list(dict.fromkeys(names))
+
+# Helper function to serve a paginated order listing shaped by ?fields= and ?include=
+def order_listing(query, default_embeds=()):
+    """Paginate an Order query returning only the order fields and embedded records the client asked for.
+    Unrequested columns and relationships are not loaded at all."""
+    fields = names_arg('fields', Order.to_dict.fields, Order.to_dict.fields)
+    embeds = names_arg('include', list(ORDER_EMBEDS), default_embeds)
+    
+    # id and created_at are always loaded since pagination orders by them
+    columns = dict.fromkeys(['id', 'created_at', *fields])
+    query = query.options(
+        load_only(*[getattr(Order, column) for column in columns]),
+        *[ORDER_EMBEDS[embed][0] for embed in embeds]
+    )
+    orders, next_cursor = paginate(query, Order)
+    
+    serialize = serializer(*fields)
+    return page_response([{
+        **serialize(o),
+        **{embed: ORDER_EMBEDS[embed][1](o) for embed in embeds}
+    } for o in orders], next_cursor)
+
+# Rows fetched per round trip when streaming exports
+EXPORT_BATCH_SIZE = 1000
+
+# Helper function to stream the payment ledger as a CSV or NDJSON download
+def payment_export(filters, filename):
+    """Stream payments matching filters plus ?since=&until=, oldest first, in the ?format= requested (csv by default).
+    Rows are read through a server-side cursor so memory use does not grow with the ledger."""
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        return make_response({'error': f'format must be one of: {", ".join(EXPORT_FORMATS)}'}, 400)
+    try:
+        since, until = parse_date_range()
+    except ValueError as e:
+        return make_response({'error': f'Invalid date range: {str(e)}'}, 400)
+    
+    columns = ['id', 'created_at', 'amount', 'method', 'transaction_id', 'order_id',
+               'customer_id', 'customer_name', 'restaurant_id', 'restaurant_name']
+    # Plain columns rather than Payment objects, so streamed rows are not kept in the session
+    statement = db.select(
+        Payment.id, Payment.created_at, Payment.amount, Payment.method, Payment.transaction_id, Payment.order_id,
+        Payment.customer_id, Customer.name, Payment.restaurant_id, Restaurant.name
+    ).outerjoin(
+        Customer, Payment.customer_id == Customer.id
+    ).outerjoin(
+        Restaurant, Payment.restaurant_id == Restaurant.id
+    ).where(
+        *filters, *date_range_filters(Payment.created_at, since, until)
+    ).order_by(Payment.created_at, Payment.id)
+    
+    rows = db.session.execute(statement.execution_options(yield_per=EXPORT_BATCH_SIZE))
+    return export_response(rows, columns, fmt, filename)
 
 #1. Authentication Routes
 class Login(Resource):
@@ -210,18 +699,8 @@ class AdminRestaurants(Resource):
         if session.get('user_type') != 'admin':
             return make_response({'error': 'Unauthorized'}, 403)
         
-        restaurants = Restaurant.query.all()
-        return make_response([{
-            'id': r.id,
-            'name': r.name,
-            'email': r.email,
-            'address': r.address,
-            'contact': r.contact,
-            'rating': r.rating,
-            'logo': r.logo,
-            'paybill_number': r.paybill_number,
-            'bio': r.bio
-        } for r in restaurants], 200)
+        restaurants, next_cursor = paginate(Restaurant.query, Restaurant)
+        return page_response([restaurant_details(r) for r in restaurants], next_cursor)
     
     def post(self):
         if session.get('user_type') != 'admin':
@@ -256,17 +735,7 @@ class AdminRestaurantById(Resource):
         if not restaurant:
             return make_response({'error': 'Restaurant not found'}, 404)
         
-        return make_response({
-            'id': restaurant.id,
-            'name': restaurant.name,
-            'email': restaurant.email,
-            'address': restaurant.address,
-            'contact': restaurant.contact,
-            'rating': restaurant.rating,
-            'logo': restaurant.logo,
-            'paybill_number': restaurant.paybill_number,
-            'bio': restaurant.bio
-        }, 200)
+        return make_response(restaurant_details(restaurant), 200)
     
     def delete(self, id):
         if session.get('user_type') != 'admin':
@@ -286,23 +755,38 @@ class AdminPayments(Resource):
         if session.get('user_type') != 'admin':
             return make_response({'error': 'Unauthorized'}, 403)
         
-        payments = Payment.query.all()
+        # Fetch customer and restaurant names in the same query instead of one lookup per payment
+        payments = db.session.query(
+            Payment,
+            Customer.name,
+            Restaurant.name
+        ).outerjoin(
+            Customer, Payment.customer_id == Customer.id
+        ).outerjoin(
+            Restaurant, Payment.restaurant_id == Restaurant.id
+        )
+        payments, next_cursor = paginate(payments, Payment)
         result = []
-        for p in payments:
-            customer = Customer.query.get(p.customer_id)
-            restaurant = Restaurant.query.get(p.restaurant_id)
+        for p, customer_name, restaurant_name in payments:
             result.append({
-                'id': p.id,
-                'amount': p.amount,
-                'method': p.method,
-                'created_at': p.created_at.isoformat(),
-                'order_id': p.order_id,
-                'customer_id': p.customer_id,
-                'customer_name': customer.name if customer else 'Unknown Customer',
-                'restaurant_id': p.restaurant_id,
-                'restaurant_name': restaurant.name if restaurant else 'Unknown Restaurant'
+                **p.to_dict(),
+                'customer_name': customer_name if customer_name else 'Unknown Customer',
+                'restaurant_name': restaurant_name if restaurant_name else 'Unknown Restaurant'
             })
-        return make_response(result, 200)
+        return page_response(result, next_cursor)
+
+class AdminPaymentsExport(Resource):
+    def get(self):
+        if session.get('user_type') != 'admin':
+            return make_response({'error': 'Unauthorized'}, 403)
+        
+        filters = []
+        if 'restaurant_id' in request.args:
+            restaurant_id = request.args.get('restaurant_id', type=int)
+            if restaurant_id is None:
+                return make_response({'error': 'restaurant_id must be an integer'}, 400)
+            filters.append(Payment.restaurant_id == restaurant_id)
+        return payment_export(filters, 'payments')
 
 class AdminPaymentById(Resource):
     def delete(self, id):
@@ -313,6 +797,7 @@ class AdminPaymentById(Resource):
         if not payment:
             return make_response({'error': 'Payment not found'}, 404)
         
+        adjust_payment_stats(payment, sign=-1)
         db.session.delete(payment)
         db.session.commit()
         
@@ -323,14 +808,8 @@ class AdminCustomers(Resource):
         if session.get('user_type') != 'admin':
             return make_response({'error': 'Unauthorized'}, 403)
         
-        customers = Customer.query.all()
-        return make_response([{
-            'id': c.id,
-            'name': c.name,
-            'email': c.email,
-            'contact': c.contact,
-            'image': c.image
-        } for c in customers], 200)
+        customers, next_cursor = paginate(Customer.query, Customer)
+        return page_response([c.to_dict() for c in customers], next_cursor)
 
 class AdminCustomerById(Resource):
     def delete(self, id):
@@ -351,98 +830,155 @@ class AdminTopRestaurants(Resource):
         if session.get('user_type') != 'admin':
             return make_response({'error': 'Unauthorized'}, 403)
         
-        # Get top 5 restaurants by order count
+        limit = max(1, min(request.args.get('limit', 5, type=int), 100))
+        try:
+            since, until = parse_date_range()
+        except ValueError as e:
+            return make_response({'error': f'Invalid date range: {str(e)}'}, 400)
+        
+        # Pre-aggregate order counts and revenue per restaurant, then join both once
+        order_counts = db.session.query(
+            Order.restaurant_id.label('restaurant_id'),
+            db.func.count(Order.id).label('order_count')
+        ).filter(
+            *date_range_filters(Order.created_at, since, until)
+        ).group_by(Order.restaurant_id).subquery()
+        
+        revenues = db.session.query(
+            Payment.restaurant_id.label('restaurant_id'),
+            db.func.sum(Payment.amount).label('total_revenue')
+        ).filter(
+            *date_range_filters(Payment.created_at, since, until)
+        ).group_by(Payment.restaurant_id).subquery()
+        
+        order_count = db.func.coalesce(order_counts.c.order_count, 0)
         top_restaurants = db.session.query(
             Restaurant,
-            db.func.count(Order.id).label('order_count')
-        ).outerjoin(Order).group_by(
-            Restaurant.id
+            order_count.label('order_count'),
+            db.func.coalesce(revenues.c.total_revenue, 0).label('total_revenue')
+        ).outerjoin(
+            order_counts, order_counts.c.restaurant_id == Restaurant.id
+        ).outerjoin(
+            revenues, revenues.c.restaurant_id == Restaurant.id
         ).order_by(
-            db.func.count(Order.id).desc()
-        ).limit(5).all()
-        
-        result = []
-        for restaurant, order_count in top_restaurants:
-            # Calculate total revenue for this restaurant
-            total_revenue = db.session.query(
-                db.func.sum(Payment.amount)
-            ).filter_by(restaurant_id=restaurant.id).scalar() or 0
-            
-            result.append({
-                'id': restaurant.id,
-                'name': restaurant.name,
-                'email': restaurant.email,
-                'address': restaurant.address,
-                'contact': restaurant.contact,
-                'rating': restaurant.rating,
-                'logo': restaurant.logo,
-                'order_count': order_count,
-                'total_revenue': total_revenue
-            })
+            order_count.desc(), Restaurant.id
+        ).limit(limit).all()
         
-        return make_response(result, 200)
+        return make_response([{
+            **leaderboard_restaurant(restaurant),
+            'order_count': order_count,
+            'total_revenue': total_revenue
+        } for restaurant, order_count, total_revenue in top_restaurants], 200)
 
 class AdminTopCustomers(Resource):
     def get(self):
         if session.get('user_type') != 'admin':
             return make_response({'error': 'Unauthorized'}, 403)
         
-        # Get top 5 customers by order count
+        limit = max(1, min(request.args.get('limit', 5, type=int), 100))
+        try:
+            since, until = parse_date_range()
+        except ValueError as e:
+            return make_response({'error': f'Invalid date range: {str(e)}'}, 400)
+        
+        # Pre-aggregate order counts and spend per customer, then join both once
+        order_counts = db.session.query(
+            Order.customer_id.label('customer_id'),
+            db.func.count(Order.id).label('order_count')
+        ).filter(
+            *date_range_filters(Order.created_at, since, until)
+        ).group_by(Order.customer_id).subquery()
+        
+        spends = db.session.query(
+            Payment.customer_id.label('customer_id'),
+            db.func.sum(Payment.amount).label('total_spent')
+        ).filter(
+            *date_range_filters(Payment.created_at, since, until)
+        ).group_by(Payment.customer_id).subquery()
+        
+        order_count = db.func.coalesce(order_counts.c.order_count, 0)
         top_customers = db.session.query(
             Customer,
-            db.func.count(Order.id).label('order_count')
-        ).outerjoin(Order).group_by(
-            Customer.id
+            order_count.label('order_count'),
+            db.func.coalesce(spends.c.total_spent, 0).label('total_spent')
+        ).outerjoin(
+            order_counts, order_counts.c.customer_id == Customer.id
+        ).outerjoin(
+            spends, spends.c.customer_id == Customer.id
         ).order_by(
-            db.func.count(Order.id).desc()
-        ).limit(5).all()
+            order_count.desc(), Customer.id
+        ).limit(limit).all()
         
-        result = []
-        for customer, order_count in top_customers:
-            # Calculate total spent by this customer
-            total_spent = db.session.query(
-                db.func.sum(Payment.amount)
-            ).filter_by(customer_id=customer.id).scalar() or 0
-            
-            result.append({
-                'id': customer.id,
-                'name': customer.name,
-                'email': customer.email,
-                'contact': customer.contact,
-                'image': customer.image,
-                'order_count': order_count,
-                'total_spent': total_spent
-            })
+        return make_response([{
+            **customer.to_dict(),
+            'order_count': order_count,
+            'total_spent': total_spent
+        } for customer, order_count, total_spent in top_customers], 200)
+
+class AdminStatsDaily(Resource):
+    def get(self):
+        if session.get('user_type') != 'admin':
+            return make_response({'error': 'Unauthorized'}, 403)
         
-        return make_response(result, 200)
+        try:
+            since, until = parse_day_range()
+        except ValueError as e:
+            return make_response({'error': f'Invalid date range: {str(e)}'}, 400)
+        
+        restaurant_id = None
+        if 'restaurant_id' in request.args:
+            restaurant_id = request.args.get('restaurant_id', type=int)
+            if restaurant_id is None:
+                return make_response({'error': 'restaurant_id must be an integer'}, 400)
+        
+        return make_response(daily_stats_series(since, until, restaurant_id), 200)
 
 api.add_resource(AdminRestaurants, '/api/admin/restaurants')
 api.add_resource(AdminRestaurantById, '/api/admin/restaurants/<int:id>')
 api.add_resource(AdminPayments, '/api/admin/payments')
+api.add_resource(AdminPaymentsExport, '/api/admin/payments/export')
 api.add_resource(AdminPaymentById, '/api/admin/payments/<int:id>')
 api.add_resource(AdminCustomers, '/api/admin/customers')
 api.add_resource(AdminCustomerById, '/api/admin/customers/<int:id>')
 api.add_resource(AdminTopRestaurants, '/api/admin/top-restaurants')
 api.add_resource(AdminTopCustomers, '/api/admin/top-customers')
+api.add_resource(AdminStatsDaily, '/api/admin/stats/daily')
 
 # Platform-wide stats endpoint (public)
+# Set PLATFORM_STATS_APPROXIMATE=1 to read Postgres planner estimates instead of running COUNT(*)
+PLATFORM_STATS_APPROXIMATE = os.getenv('PLATFORM_STATS_APPROXIMATE', '').lower() in ('1', 'true', 'yes')
+
+def platform_counts():
+    """Count restaurants, customers and delivery agents in a single statement"""
+    if PLATFORM_STATS_APPROXIMATE and db.engine.dialect.name == 'postgresql':
+        estimates = db.session.execute(db.text(
+            "SELECT "
+            "(SELECT reltuples::bigint FROM pg_class WHERE oid = 'restaurants'::regclass), "
+            "(SELECT reltuples::bigint FROM pg_class WHERE oid = 'customers'::regclass), "
+            "(SELECT reltuples::bigint FROM pg_class WHERE oid = 'delivery_agents'::regclass)"
+        )).one()
+        # reltuples is -1 until a table has been analyzed, so only trust real estimates
+        if all(estimate >= 0 for estimate in estimates):
+            return dict(zip(('restaurants', 'customers', 'agents'), estimates))
+    
+    counts = db.session.query(
+        db.select(db.func.count(Restaurant.id)).scalar_subquery(),
+        db.select(db.func.count(Customer.id)).scalar_subquery(),
+        db.select(db.func.count(DeliveryAgent.id)).scalar_subquery()
+    ).one()
+    return dict(zip(('restaurants', 'customers', 'agents'), counts))
+
 class PlatformStats(Resource):
+    @response_cache.cached('restaurants', 'customers', 'delivery_agents')
     def get(self):
         """Get platform-wide statistics for the homepage"""
-        total_restaurants = Restaurant.query.count()
-        total_customers = Customer.query.count()
-        total_agents = DeliveryAgent.query.count()
-        
-        return make_response({
-            'restaurants': total_restaurants,
-            'customers': total_customers,
-            'agents': total_agents
-        }, 200)
+        return make_response(platform_counts(), 200)
 
 api.add_resource(PlatformStats, '/api/stats')
 
 # Homepage public endpoints
 class HomepageTopRestaurants(Resource):
+    @response_cache.cached('restaurants', 'orders')
     def get(self):
         """Get top 5 restaurants by order count for homepage (public endpoint)"""
         # Get top 5 restaurants by order count
@@ -458,48 +994,42 @@ class HomepageTopRestaurants(Resource):
         result = []
         for restaurant, order_count in top_restaurants:
             result.append({
-                'id': restaurant.id,
-                'name': restaurant.name,
-                'rating': restaurant.rating,
-                'logo': restaurant.logo,
-                'address': restaurant.address,
-                'bio': restaurant.bio,
+                **homepage_restaurant(restaurant),
                 'order_count': order_count
             })
         
         return make_response(result, 200)
 
 class HomepageTopMenuItems(Resource):
+    @response_cache.cached('menu_items', 'order_menu_items', 'restaurants')
     def get(self):
-        """Get top 5 menu items by order count for homepage (public endpoint)"""
-        # Get menu items with their order counts
-        # First, get all menu items with their order counts
-        menu_items_query = db.session.query(
-            MenuItem
-        ).all()
-        
-        # Calculate order count for each menu item
-        result = []
-        for menu_item in menu_items_query:
-            order_count = len(menu_item.order_menu_items)
-            restaurant = menu_item.restaurant
-            result.append({
-                'id': menu_item.id,
-                'name': menu_item.name,
-                'unit_price': menu_item.unit_price,
-                'image': menu_item.image,
-                'description': menu_item.description,
-                'restaurant_id': menu_item.restaurant_id,
-                'restaurant_name': restaurant.name if restaurant else 'Unknown Restaurant',
-                'restaurant_logo': restaurant.logo if restaurant else None,
-                'order_count': order_count
-            })
-        
-        # Sort by order count descending and take top 5
-        result.sort(key=lambda x: x['order_count'], reverse=True)
-        result = result[:5]
+        """Get top 5 menu items by quantity ordered for homepage (public endpoint)"""
+        # Total the quantity ordered per menu item in SQL and let the database pick the top 5
+        quantities = db.session.query(
+            OrderMenuItem.menu_item_id.label('menu_item_id'),
+            db.func.sum(OrderMenuItem.quantity).label('quantity')
+        ).group_by(OrderMenuItem.menu_item_id).subquery()
+        
+        order_count = db.func.coalesce(quantities.c.quantity, 0)
+        top_menu_items = db.session.query(
+            MenuItem,
+            Restaurant.name,
+            Restaurant.logo,
+            order_count.label('order_count')
+        ).outerjoin(
+            quantities, quantities.c.menu_item_id == MenuItem.id
+        ).outerjoin(
+            Restaurant, MenuItem.restaurant_id == Restaurant.id
+        ).order_by(
+            order_count.desc(), MenuItem.id
+        ).limit(5).all()
         
-        return make_response(result, 200)
+        return make_response([{
+            **homepage_menu_item(menu_item),
+            'restaurant_name': restaurant_name if restaurant_name else 'Unknown Restaurant',
+            'restaurant_logo': restaurant_logo,
+            'order_count': order_count
+        } for menu_item, restaurant_name, restaurant_logo, order_count in top_menu_items], 200)
 
 api.add_resource(HomepageTopRestaurants, '/api/homepage/top-restaurants')
 api.add_resource(HomepageTopMenuItems, '/api/homepage/top-menu-items')
@@ -516,17 +1046,7 @@ class RestaurantAccount(Resource):
         if not restaurant:
             return make_response({'error': 'Restaurant not found'}, 404)
         
-        return make_response({
-            'id': restaurant.id,
-            'name': restaurant.name,
-            'email': restaurant.email,
-            'address': restaurant.address,
-            'contact': restaurant.contact,
-            'logo': restaurant.logo,
-            'paybill_number': restaurant.paybill_number,
-            'bio': restaurant.bio,
-            'rating': restaurant.rating
-        }, 200)
+        return make_response(restaurant_details(restaurant), 200)
     
     def patch(self):
         if session.get('user_type') != 'restaurant':
@@ -560,14 +1080,7 @@ class RestaurantAccount(Resource):
         
         return make_response({
             'message': 'Restaurant updated',
-            'id': restaurant.id,
-            'name': restaurant.name,
-            'email': restaurant.email,
-            'address': restaurant.address,
-            'contact': restaurant.contact,
-            'logo': restaurant.logo,
-            'paybill_number': restaurant.paybill_number,
-            'bio': restaurant.bio
+            **restaurant_details(restaurant)
         }, 200)
     
     def delete(self):
@@ -593,17 +1106,9 @@ class RestaurantMenuItems(Resource):
             return make_response({'error': 'Unauthorized'}, 403)
         
         restaurant_id = session.get('user_id')
-        menu_items = MenuItem.query.filter_by(restaurant_id=restaurant_id).all()
+        menu_items, next_cursor = paginate(MenuItem.query.filter_by(restaurant_id=restaurant_id), MenuItem)
         
-        return make_response([{
-            'id': m.id,
-            'name': m.name,
-            'unit_price': m.unit_price,
-            'image': m.image,
-            'description': m.description,
-            'availability': m.availability,
-            'restaurant_id': m.restaurant_id
-        } for m in menu_items], 200)
+        return page_response([m.to_dict() for m in menu_items], next_cursor)
     
     def post(self):
         if session.get('user_type') != 'restaurant':
@@ -640,15 +1145,7 @@ class RestaurantMenuItemById(Resource):
         if menu_item.restaurant_id != restaurant_id:
             return make_response({'error': 'Unauthorized'}, 403)
         
-        return make_response({
-            'id': menu_item.id,
-            'name': menu_item.name,
-            'unit_price': menu_item.unit_price,
-            'image': menu_item.image,
-            'description': menu_item.description,
-            'availability': menu_item.availability,
-            'restaurant_id': menu_item.restaurant_id
-        }, 200)
+        return make_response(menu_item.to_dict(), 200)
     
     def patch(self, id):
         if session.get('user_type') != 'restaurant':
@@ -704,60 +1201,9 @@ class RestaurantOrders(Resource):
             return make_response({'error': 'Unauthorized'}, 403)
         
         restaurant_id = session.get('user_id')
-        orders = Order.query.filter_by(restaurant_id=restaurant_id).all()
-        
-        result = []
-        for o in orders:
-            # Build menu items list with quantities from OrderMenuItem
-            menu_items = []
-            for order_item in o.order_menu_items:
-                menu_item = order_item.menu_item
-                menu_items.append({
-                    'id': menu_item.id,
-                    'name': menu_item.name,
-                    'unit_price': menu_item.unit_price,
-                    'image': menu_item.image,
-                    'quantity': order_item.quantity
-                })
-            
-            # Get customer details
-            customer = o.customer
-            customer_data = None
-            if customer:
-                customer_data = {
-                    'id': customer.id,
-                    'name': customer.name,
-                    'image': customer.image,
-                    'contact': customer.contact
-                }
-            
-            # Get delivery agent details
-            agent = o.delivery_agent
-            agent_data = None
-            if agent:
-                agent_data = {
-                    'id': agent.id,
-                    'name': agent.name,
-                    'image': agent.image,
-                    'contact': agent.contact
-                }
-            
-            result.append({
-                'id': o.id,
-                'created_at': o.created_at.isoformat() if o.created_at else None,
-                'delivery_time': o.delivery_time.isoformat() if o.delivery_time else None,
-                'delivery_address': o.delivery_address,
-                'payment_status': o.payment_status,
-                'total_price': o.total_price,
-                'restaurant_id': o.restaurant_id,
-                'delivery_agent_id': o.delivery_agent_id,
-                'customer_id': o.customer_id,
-                'customer': customer_data,
-                'delivery_agent': agent_data,
-                'menu_items': menu_items
-            })
-        
-        return make_response(result, 200)
+        return order_listing(
+            Order.query.filter_by(restaurant_id=restaurant_id), ('customer', 'delivery_agent', 'menu_items')
+        )
 
 
 class RestaurantOrderById(Resource):
@@ -774,17 +1220,7 @@ class RestaurantOrderById(Resource):
         if order.restaurant_id != restaurant_id:
             return make_response({'error': 'Unauthorized'}, 403)
         
-        return make_response({
-            'id': order.id,
-            'created_at': order.created_at.isoformat() if order.created_at else None,
-            'delivery_time': order.delivery_time.isoformat() if order.delivery_time else None,
-            'delivery_address': order.delivery_address,
-            'payment_status': order.payment_status,
-            'total_price': order.total_price,
-            'restaurant_id': order.restaurant_id,
-            'delivery_agent_id': order.delivery_agent_id,
-            'customer_id': order.customer_id,
-        }, 200)
+        return make_response(order.to_dict(), 200)
     
     def patch(self, id):
         if session.get('user_type') != 'restaurant':
@@ -827,6 +1263,7 @@ class RestaurantOrderById(Resource):
         if order.restaurant_id != restaurant_id:
             return make_response({'error': 'Unauthorized'}, 403)
         
+        remove_order_stats(order)
         db.session.delete(order)
         db.session.commit()
         
@@ -839,24 +1276,36 @@ class RestaurantPayments(Resource):
             return make_response({'error': 'Unauthorized'}, 403)
         
         restaurant_id = session.get('user_id')
-        payments = Payment.query.filter_by(restaurant_id=restaurant_id).all()
+        # Fetch customer details in the same query instead of one lookup per payment
+        payments = db.session.query(
+            Payment,
+            Customer.name,
+            Customer.image
+        ).outerjoin(
+            Customer, Payment.customer_id == Customer.id
+        ).filter(
+            Payment.restaurant_id == restaurant_id
+        )
+        payments, next_cursor = paginate(payments, Payment)
         
         result = []
-        for p in payments:
-            customer= Customer.query.filter_by(id=p.customer_id).first()
+        for p, customer_name, customer_image in payments:
             result.append({
-                'id': p.id,
-                'amount': p.amount,
-                'method': p.method,
-                'created_at': p.created_at.isoformat() if p.created_at else None,
-                'order_id': p.order_id,
-                'customer_id': p.customer_id,
-                'restaurant_id': p.restaurant_id,
-                'customer_name': customer.name if customer else 'Unknown',
-                'customer_image': customer.image if customer else None
+                **p.to_dict(),
+                'customer_name': customer_name if customer_name else 'Unknown',
+                'customer_image': customer_image
             })
         
-        return make_response(result, 200)
+        return page_response(result, next_cursor)
+
+
+class RestaurantPaymentsExport(Resource):
+    def get(self):
+        if session.get('user_type') != 'restaurant':
+            return make_response({'error': 'Unauthorized'}, 403)
+        
+        restaurant_id = session.get('user_id')
+        return payment_export([Payment.restaurant_id == restaurant_id], f'payments-restaurant-{restaurant_id}')
 
 
 class RestaurantDeliveryAgents(Resource):
@@ -865,17 +1314,9 @@ class RestaurantDeliveryAgents(Resource):
             return make_response({'error': 'Unauthorized'}, 403)
         
         restaurant_id = session.get('user_id')
-        agents = DeliveryAgent.query.filter_by(restaurant_id=restaurant_id).all()
+        agents, next_cursor = paginate(DeliveryAgent.query.filter_by(restaurant_id=restaurant_id), DeliveryAgent)
         
-        return make_response([{
-            'id': a.id,
-            'name': a.name,
-            'email': a.email,
-            'contact': a.contact,
-            'image': a.image,
-            'rating': a.rating,
-            'restaurant_id': a.restaurant_id
-        } for a in agents], 200)
+        return page_response([a.to_dict() for a in agents], next_cursor)
     
     def post(self):
         if session.get('user_type') != 'restaurant':
@@ -941,11 +1382,7 @@ class RestaurantTopCustomers(Resource):
         ).limit(5).all()
         
         return make_response([{
-            'id': customer.id,
-            'name': customer.name,
-            'email': customer.email,
-            'contact': customer.contact,
-            'image': customer.image,
+            **customer.to_dict(),
             'order_count': order_count
         } for customer, order_count in top_customers], 200)
 
@@ -956,23 +1393,34 @@ class RestaurantReviews(Resource):
             return make_response({'error': 'Unauthorized'}, 403)
         
         restaurant_id = session.get('user_id')
-        reviews = RestaurantReview.query.filter_by(restaurant_id=restaurant_id).all()
+        reviews, next_cursor = paginate(
+            RestaurantReview.query.options(joinedload(RestaurantReview.customer)).filter_by(restaurant_id=restaurant_id),
+            RestaurantReview
+        )
         
         result = []
         for r in reviews:
             customer = r.customer
             result.append({
-                'id': r.id,
-                'comment': r.comment,
-                'rating': r.rating,
-                'created_at': r.created_at.isoformat() if r.created_at else None,
-                'restaurant_id': r.restaurant_id,
-                'customer_id': r.customer_id,
+                **r.to_dict(),
                 'customer_name': customer.name if customer else 'Anonymous',
                 'customer_image': customer.image if customer else None
             })
         
-        return make_response(result, 200)
+        return page_response(result, next_cursor)
+
+
+class RestaurantStatsDaily(Resource):
+    def get(self):
+        if session.get('user_type') != 'restaurant':
+            return make_response({'error': 'Unauthorized'}, 403)
+        
+        try:
+            since, until = parse_day_range()
+        except ValueError as e:
+            return make_response({'error': f'Invalid date range: {str(e)}'}, 400)
+        
+        return make_response(daily_stats_series(since, until, session.get('user_id')), 200)
 
 
 api.add_resource(RestaurantAccount, '/api/restaurant/account')
@@ -981,10 +1429,12 @@ api.add_resource(RestaurantMenuItemById, '/api/restaurant/menuitems/<int:id>')
 api.add_resource(RestaurantOrders, '/api/restaurant/orders')
 api.add_resource(RestaurantOrderById, '/api/restaurant/orders/<int:id>')
 api.add_resource(RestaurantPayments, '/api/restaurant/payments')
+api.add_resource(RestaurantPaymentsExport, '/api/restaurant/payments/export')
 api.add_resource(RestaurantDeliveryAgents, '/api/restaurant/agents')
 api.add_resource(RestaurantDeliveryAgentById, '/api/restaurant/agents/<int:id>')
 api.add_resource(RestaurantTopCustomers, '/api/restaurant/top-customers')
 api.add_resource(RestaurantReviews, '/api/restaurant/reviews')
+api.add_resource(RestaurantStatsDaily, '/api/restaurant/stats/daily')
 
 #4. Customer routes
 class CustomerAccount(Resource):
@@ -998,13 +1448,7 @@ class CustomerAccount(Resource):
         if not customer:
             return make_response({'error': 'Customer not found'}, 404)
         
-        return make_response({
-            'id': customer.id,
-            'name': customer.name,
-            'email': customer.email,
-            'contact': customer.contact,
-            'image': customer.image
-        }, 200)
+        return make_response(customer.to_dict(), 200)
     
     def patch(self):
         if session.get('user_type') != 'customer':
@@ -1032,11 +1476,7 @@ class CustomerAccount(Resource):
         
         return make_response({
             'message': 'Customer updated',
-            'id': customer.id,
-            'name': customer.name,
-            'email': customer.email,
-            'contact': customer.contact,
-            'image': customer.image
+            **customer.to_dict()
         }, 200)
     
     def delete(self):
@@ -1057,57 +1497,32 @@ class CustomerAccount(Resource):
 
 
 class CustomerRestaurants(Resource):
+    @response_cache.cached('restaurants', conditional=True)
     def get(self):
-        restaurants = Restaurant.query.all()
-        return make_response([{
-            'id': r.id,
-            'name': r.name,
-            'email': r.email,
-            'address': r.address,
-            'contact': r.contact,
-            'rating': r.rating,
-            'logo': r.logo,
-            'paybill_number': r.paybill_number,
-            'bio': r.bio
-        } for r in restaurants], 200)
+        restaurants, next_cursor = paginate(Restaurant.query, Restaurant)
+        return page_response([restaurant_details(r) for r in restaurants], next_cursor)
 
 
 class CustomerRestaurantById(Resource):
+    @response_cache.cached('restaurants', conditional=True)
     def get(self, id):
         restaurant = Restaurant.query.get(id)
         if not restaurant:
             return make_response({'error': 'Restaurant not found'}, 404)
         
-        return make_response({
-            'id': restaurant.id,
-            'name': restaurant.name,
-            'email': restaurant.email,
-            'address': restaurant.address,
-            'contact': restaurant.contact,
-            'rating': restaurant.rating,
-            'logo': restaurant.logo,
-            'paybill_number': restaurant.paybill_number,
-            'bio': restaurant.bio
-        }, 200)
+        return make_response(restaurant_details(restaurant), 200)
 
 
 class CustomerMenuItems(Resource):
+    @response_cache.cached('menu_items:{restaurant_id}', conditional=True)
     def get(self):
         restaurant_id = request.args.get('restaurant_id')
         if not restaurant_id:
             return make_response({'error': 'restaurant_id query parameter is required'}, 400)
         
-        menu_items = MenuItem.query.filter_by(restaurant_id=restaurant_id, availability=True).all()
+        menu_items, next_cursor = paginate(MenuItem.query.filter_by(restaurant_id=restaurant_id, availability=True), MenuItem)
         
-        return make_response([{
-            'id': m.id,
-            'name': m.name,
-            'unit_price': m.unit_price,
-            'image': m.image,
-            'description': m.description,
-            'availability': m.availability,
-            'restaurant_id': m.restaurant_id
-        } for m in menu_items], 200)
+        return page_response([m.to_dict() for m in menu_items], next_cursor)
 
 
 class CustomerOrders(Resource):
@@ -1116,48 +1531,9 @@ class CustomerOrders(Resource):
             return make_response({'error': 'Unauthorized'}, 403)
         
         customer_id = session.get('user_id')
-        orders = Order.query.filter_by(customer_id=customer_id).all()
-        
-        result = []
-        for o in orders:
-            # Get restaurant details
-            restaurant = o.restaurant
-            restaurant_data = None
-            if restaurant:
-                restaurant_data = {
-                    'id': restaurant.id,
-                    'name': restaurant.name,
-                    'logo': restaurant.logo
-                }
-            
-            # Build menu items list with quantities from OrderMenuItem
-            menu_items = []
-            for order_item in o.order_menu_items:
-                menu_item = order_item.menu_item
-                menu_items.append({
-                    'id': menu_item.id,
-                    'name': menu_item.name,
-                    'unit_price': menu_item.unit_price,
-                    'image': menu_item.image,
-                    'quantity': order_item.quantity
-                })
-            
-            result.append({
-                'id': o.id,
-                'created_at': o.created_at.isoformat() if o.created_at else None,
-                'delivery_time': o.delivery_time.isoformat() if o.delivery_time else None,
-                'delivery_address': o.delivery_address,
-                'payment_status': o.payment_status,
-                'total_price': o.total_price,
-                'restaurant_id': o.restaurant_id,
-                'delivery_agent_id': o.delivery_agent_id,
-                'customer_id': o.customer_id,
-                'restaurant': restaurant_data,
-                'menu_items': menu_items
-            })
-        
-        return make_response(result, 200)
+        return order_listing(Order.query.filter_by(customer_id=customer_id), ('restaurant', 'menu_items'))
     
+    @idempotency.idempotent
     def post(self):
         if session.get('user_type') != 'customer':
             return make_response({'error': 'Unauthorized'}, 403)
@@ -1168,20 +1544,29 @@ class CustomerOrders(Resource):
         delivery_address = data.get('delivery_address')
         menu_items_data = data.get('menu_items', [])
         menu_item_ids = data.get('menu_item_ids', [])  # Backward compatibility
-        total_price = data.get('total_price')
         
         # Handle both old and new formats
         if not menu_items_data and menu_item_ids:
             # Convert old format to new format
             menu_items_data = [{'id': item_id, 'quantity': 1} for item_id in menu_item_ids]
         
-        if not restaurant_id or not delivery_address or not menu_items_data or total_price is None:
-            return make_response({'error': 'restaurant_id, delivery_address, menu_items and total_price are required'}, 400)
+        if not restaurant_id or not delivery_address or not menu_items_data:
+            return make_response({'error': 'restaurant_id, delivery_address and menu_items are required'}, 400)
         
         restaurant = Restaurant.query.get(restaurant_id)
         if not restaurant:
             return make_response({'error': 'Restaurant not found'}, 404)
         
+        quantities, menu_items, error = load_cart(restaurant_id, menu_items_data)
+        if error:
+            return make_response({'error': error}, 400)
+        
+        # Price the order from the menu rather than trusting the client's total
+        total_price = round(sum(
+            menu_items[menu_item_id].unit_price * quantity
+            for menu_item_id, quantity in quantities.items()
+        ), 2)
+        
         try:
             order = Order(
                 restaurant_id=restaurant_id,
@@ -1192,23 +1577,16 @@ class CustomerOrders(Resource):
             db.session.add(order)
             db.session.flush()
             
-            # Add menu items with quantities
-            for item_data in menu_items_data:
-                menu_item_id = item_data.get('id')
-                quantity = item_data.get('quantity', 1)
-                
-                menu_item = MenuItem.query.get(menu_item_id)
-                if menu_item:
-                    order_menu_item = OrderMenuItem(
-                        order_id=order.id,
-                        menu_item_id=menu_item_id,
-                        quantity=quantity
-                    )
-                    db.session.add(order_menu_item)
+            # Add menu items with quantities in a single bulk insert
+            db.session.execute(db.insert(OrderMenuItem), [
+                {'order_id': order.id, 'menu_item_id': menu_item_id, 'quantity': quantity}
+                for menu_item_id, quantity in quantities.items()
+            ])
+            adjust_order_stats(order, sum(quantities.values()))
             
             db.session.commit()
             
-            return make_response({'message': 'Order created', 'id': order.id}, 201)
+            return make_response({'message': 'Order created', 'id': order.id, 'total_price': total_price}, 201)
         except Exception as e:
             db.session.rollback()
             return make_response({'error': f'Failed to create order: {str(e)}'}, 500)
@@ -1220,45 +1598,19 @@ class CustomerOrderById(Resource):
             return make_response({'error': 'Unauthorized'}, 403)
         
         customer_id = session.get('user_id')
-        order = Order.query.get(id)
+        order = order_query(Order.restaurant).filter_by(id=id).first()
         
         if not order or order.customer_id != customer_id:
             return make_response({'error': 'Order not found'}, 404)
         
         # Get restaurant details
-        restaurant = order.restaurant
-        restaurant_data = None
-        if restaurant:
-            restaurant_data = {
-                'id': restaurant.id,
-                'name': restaurant.name,
-                'logo': restaurant.logo,
-                'contact': restaurant.contact,
-                'address': restaurant.address
-            }
+        restaurant_data = restaurant_contact(order.restaurant) if order.restaurant else None
         
         # Build menu items list with quantities from OrderMenuItem
-        menu_items = []
-        for order_item in order.order_menu_items:
-            menu_item = order_item.menu_item
-            menu_items.append({
-                'id': menu_item.id,
-                'name': menu_item.name,
-                'unit_price': menu_item.unit_price,
-                'image': menu_item.image,
-                'quantity': order_item.quantity
-            })
+        menu_items = order_lines(order)
         
         return make_response({
-            'id': order.id,
-            'created_at': order.created_at.isoformat() if order.created_at else None,
-            'delivery_time': order.delivery_time.isoformat() if order.delivery_time else None,
-            'delivery_address': order.delivery_address,
-            'payment_status': order.payment_status,
-            'total_price': order.total_price,
-            'restaurant_id': order.restaurant_id,
-            'delivery_agent_id': order.delivery_agent_id,
-            'customer_id': order.customer_id,
+            **order.to_dict(),
             'restaurant': restaurant_data,
             'menu_items': menu_items
         }, 200)
@@ -1276,26 +1628,53 @@ class CustomerOrderById(Resource):
         data = request.get_json()
         if 'delivery_address' in data:
             order.delivery_address = data['delivery_address']
-        if 'total_price' in data:
-            order.total_price = data['total_price']
         if 'menu_items' in data:
-            # Clear existing menu items
-            OrderMenuItem.query.filter_by(order_id=order.id).delete()
+            existing_lines = {}
+            duplicate_line_ids = []
+            lines = OrderMenuItem.query.filter_by(order_id=order.id).all()
+            previous_items = sum(line.quantity for line in lines)
+            for line in lines:
+                if line.menu_item_id in existing_lines:
+                    duplicate_line_ids.append(line.id)
+                else:
+                    existing_lines[line.menu_item_id] = line
             
-            # Add new menu items with quantities
-            menu_items_data = data.get('menu_items', [])
-            for item_data in menu_items_data:
-                menu_item_id = item_data.get('id')
-                quantity = item_data.get('quantity', 1)
-                
-                menu_item = MenuItem.query.get(menu_item_id)
-                if menu_item:
-                    order_menu_item = OrderMenuItem(
-                        order_id=order.id,
-                        menu_item_id=menu_item_id,
-                        quantity=quantity
-                    )
-                    db.session.add(order_menu_item)
+            quantities, menu_items, error = load_cart(order.restaurant_id, data.get('menu_items') or [], existing_lines)
+            if error:
+                return make_response({'error': error}, 400)
+            if not quantities:
+                return make_response({'error': 'An order needs at least one menu item'}, 400)
+            
+            # Only touch the lines that actually changed
+            deleted_ids = duplicate_line_ids + [
+                line.id for menu_item_id, line in existing_lines.items() if menu_item_id not in quantities
+            ]
+            updated_lines = [
+                {'id': existing_lines[menu_item_id].id, 'quantity': quantity}
+                for menu_item_id, quantity in quantities.items()
+                if menu_item_id in existing_lines and existing_lines[menu_item_id].quantity != quantity
+            ]
+            new_lines = [
+                {'order_id': order.id, 'menu_item_id': menu_item_id, 'quantity': quantity}
+                for menu_item_id, quantity in quantities.items()
+                if menu_item_id not in existing_lines
+            ]
+            if deleted_ids:
+                OrderMenuItem.query.filter(OrderMenuItem.id.in_(deleted_ids)).delete(synchronize_session=False)
+            if updated_lines:
+                db.session.execute(db.update(OrderMenuItem), updated_lines)
+            if new_lines:
+                db.session.execute(db.insert(OrderMenuItem), new_lines)
+            
+            # Re-price the order from the menu
+            order.total_price = round(sum(
+                menu_items[menu_item_id].unit_price * quantity
+                for menu_item_id, quantity in quantities.items()
+            ), 2)
+            adjust_daily_stats(
+                order.restaurant_id, order.created_at,
+                items_sold=sum(quantities.values()) - previous_items
+            )
         
         db.session.commit()
         return make_response({'message': 'Order updated'}, 200)
@@ -1310,6 +1689,7 @@ class CustomerOrderById(Resource):
         if not order or order.customer_id != customer_id:
             return make_response({'error': 'Order not found'}, 404)
         
+        remove_order_stats(order)
         db.session.delete(order)
         db.session.commit()
         return make_response({'message': 'Order deleted'}, 200)
@@ -1321,25 +1701,29 @@ class CustomerPayments(Resource):
             return make_response({'error': 'Unauthorized'}, 403)
         
         customer_id = session.get('user_id')
-        payments = Payment.query.filter_by(customer_id=customer_id).all()
+        # Fetch restaurant details in the same query instead of one lookup per payment
+        payments = db.session.query(
+            Payment,
+            Restaurant.name,
+            Restaurant.logo
+        ).outerjoin(
+            Restaurant, Payment.restaurant_id == Restaurant.id
+        ).filter(
+            Payment.customer_id == customer_id
+        )
+        payments, next_cursor = paginate(payments, Payment)
         
         result = []
-        for p in payments:
-            restaurant = Restaurant.query.get(p.restaurant_id)
+        for p, restaurant_name, restaurant_logo in payments:
             result.append({
-                'id': p.id,
-                'amount': p.amount,
-                'method': p.method,
-                'created_at': p.created_at.isoformat() if p.created_at else None,
-                'order_id': p.order_id,
-                'customer_id': p.customer_id,
-                'restaurant_id': p.restaurant_id,
-                'restaurant_name': restaurant.name if restaurant else 'Unknown Restaurant',
-                'restaurant_logo': restaurant.logo if restaurant else None
+                **p.to_dict(),
+                'restaurant_name': restaurant_name if restaurant_name else 'Unknown Restaurant',
+                'restaurant_logo': restaurant_logo
             })
         
-        return make_response(result, 200)
+        return page_response(result, next_cursor)
     
+    @idempotency.idempotent
     def post(self):
         if session.get('user_type') != 'customer':
             return make_response({'error': 'Unauthorized'}, 403)
@@ -1360,16 +1744,11 @@ class CustomerPayments(Resource):
         if order.payment_status:
             return make_response({'error': 'Order already paid'}, 400)
         
-        payment = Payment(
-            order_id=order_id,
-            customer_id=customer_id,
-            restaurant_id=order.restaurant_id,
-            amount=amount,
-            method=method
-        )
-        
-        order.payment_status = True
-        db.session.add(payment)
+        payment = settle_order(order, amount, method)
+        if payment is None:
+            # Paid by a concurrent request since the check above
+            db.session.rollback()
+            return make_response({'error': 'Order already paid'}, 400)
         db.session.commit()
         
         return make_response({'message': 'Payment created', 'id': payment.id}, 201)
@@ -1381,16 +1760,9 @@ class CustomerRestaurantReviews(Resource):
             return make_response({'error': 'Unauthorized'}, 403)
         
         customer_id = session.get('user_id')
-        reviews = RestaurantReview.query.filter_by(customer_id=customer_id).all()
+        reviews, next_cursor = paginate(RestaurantReview.query.filter_by(customer_id=customer_id), RestaurantReview)
         
-        return make_response([{
-            'id': r.id,
-            'comment': r.comment,
-            'rating': r.rating,
-            'created_at': r.created_at.isoformat() if r.created_at else None,
-            'restaurant_id': r.restaurant_id,
-            'customer_id': r.customer_id
-        } for r in reviews], 200)
+        return page_response([r.to_dict() for r in reviews], next_cursor)
     
     def post(self):
         if session.get('user_type') != 'customer':
@@ -1405,6 +1777,11 @@ class CustomerRestaurantReviews(Resource):
         if not restaurant_id or not comment or rating is None:
             return make_response({'error': 'restaurant_id, comment, and rating are required'}, 400)
         
+        try:
+            rating = float(rating)
+        except (TypeError, ValueError):
+            return make_response({'error': 'rating must be a number'}, 400)
+        
         restaurant = Restaurant.query.get(restaurant_id)
         if not restaurant:
             return make_response({'error': 'Restaurant not found'}, 404)
@@ -1417,11 +1794,10 @@ class CustomerRestaurantReviews(Resource):
         )
         
         db.session.add(review)
+        # Update restaurant average rating in the same transaction
+        adjust_rating(Restaurant, restaurant_id, rating, 1)
         db.session.commit()
         
-        # Update restaurant average rating
-        update_restaurant_rating(restaurant_id)
-        
         return make_response({'message': 'Review created', 'id': review.id}, 201)
 
 
@@ -1431,15 +1807,8 @@ class CustomerDeliveryReviews(Resource):
             return make_response({'error': 'Unauthorized'}, 403)
         
         customer_id = session.get('user_id')
-        reviews = DeliveryReview.query.filter_by(customer_id=customer_id).all()
-        return make_response([{
-            'id': r.id,
-            'comment': r.comment,
-            'rating': r.rating,
-            'created_at': r.created_at.isoformat() if r.created_at else None,
-            'delivery_agent_id': r.delivery_agent_id,
-            'customer_id': r.customer_id
-        } for r in reviews], 200)
+        reviews, next_cursor = paginate(DeliveryReview.query.filter_by(customer_id=customer_id), DeliveryReview)
+        return page_response([r.to_dict() for r in reviews], next_cursor)
     
     def post(self):
         if session.get('user_type') != 'customer':
@@ -1454,6 +1823,11 @@ class CustomerDeliveryReviews(Resource):
         if not delivery_agent_id or not comment or rating is None:
             return make_response({'error': 'delivery_agent_id, comment, and rating are required'}, 400)
         
+        try:
+            rating = float(rating)
+        except (TypeError, ValueError):
+            return make_response({'error': 'rating must be a number'}, 400)
+        
         agent = DeliveryAgent.query.get(delivery_agent_id)
         if not agent:
             return make_response({'error': 'Delivery agent not found'}, 404)
@@ -1466,11 +1840,10 @@ class CustomerDeliveryReviews(Resource):
         )
         
         db.session.add(review)
+        # Update delivery agent average rating in the same transaction
+        adjust_rating(DeliveryAgent, delivery_agent_id, rating, 1)
         db.session.commit()
         
-        # Update delivery agent average rating
-        update_delivery_agent_rating(delivery_agent_id)
-        
         return make_response({'message': 'Review created', 'id': review.id}, 201)
 class CustomerRestaurantReviewById(Resource):
     def get(self, id):
@@ -1485,13 +1858,8 @@ class CustomerRestaurantReviewById(Resource):
         
         restaurant = Restaurant.query.get(review.restaurant_id)
         return make_response({
-            'id': review.id,
-            'comment': review.comment,
-            'rating': review.rating,
-            'created_at': review.created_at.isoformat() if review.created_at else None,
-            'restaurant_id': review.restaurant_id,
-            'restaurant_name': restaurant.name if restaurant else 'Unknown Restaurant',
-            'customer_id': review.customer_id
+            **review.to_dict(),
+            'restaurant_name': restaurant.name if restaurant else 'Unknown Restaurant'
         }, 200)
     
     def patch(self, id):
@@ -1505,17 +1873,19 @@ class CustomerRestaurantReviewById(Resource):
             return make_response({'error': 'Review not found'}, 404)
 
         data = request.get_json()
-        old_restaurant_id = review.restaurant_id
         if 'rating' in data:
-            review.rating = data['rating']
+            try:
+                rating = float(data['rating'])
+            except (TypeError, ValueError):
+                return make_response({'error': 'rating must be a number'}, 400)
+            # Update restaurant average rating by the change in this review's rating
+            adjust_rating(Restaurant, review.restaurant_id, rating - review.rating, 0)
+            review.rating = rating
         if 'comment' in data:
             review.comment = data['comment']
         
         db.session.commit()
         
-        # Update restaurant average rating (handle case where restaurant_id might have changed)
-        update_restaurant_rating(old_restaurant_id)
-        
         return make_response({'message': 'Review updated', 'review': {
             'id': review.id,
             'rating': review.rating,
@@ -1532,15 +1902,12 @@ class CustomerRestaurantReviewById(Resource):
         if not review or review.customer_id != customer_id:
             return make_response({'error': 'Review not found'}, 404)
 
-        # Store restaurant_id before deletion
-        restaurant_id = review.restaurant_id
+        # Update restaurant average rating in the same transaction
+        adjust_rating(Restaurant, review.restaurant_id, -review.rating, -1)
         
         db.session.delete(review)
         db.session.commit()
         
-        # Update restaurant average rating
-        update_restaurant_rating(restaurant_id)
-        
         return make_response({'message': 'Review deleted'}, 200)
 
 class CustomerDeliveryReviewById(Resource):
@@ -1556,13 +1923,8 @@ class CustomerDeliveryReviewById(Resource):
         
         agent = DeliveryAgent.query.get(review.delivery_agent_id)
         return make_response({
-            'id': review.id,
-            'comment': review.comment,
-            'rating': review.rating,
-            'created_at': review.created_at.isoformat() if review.created_at else None,
-            'delivery_agent_id': review.delivery_agent_id,
-            'agent_name': agent.name if agent else 'Unknown Agent',
-            'customer_id': review.customer_id
+            **review.to_dict(),
+            'agent_name': agent.name if agent else 'Unknown Agent'
         }, 200)
     
     def patch(self, id):
@@ -1576,17 +1938,19 @@ class CustomerDeliveryReviewById(Resource):
             return make_response({'error': 'Review not found'}, 404)
 
         data = request.get_json()
-        old_agent_id = review.delivery_agent_id
         if 'rating' in data:
-            review.rating = data['rating']
+            try:
+                rating = float(data['rating'])
+            except (TypeError, ValueError):
+                return make_response({'error': 'rating must be a number'}, 400)
+            # Update delivery agent average rating by the change in this review's rating
+            adjust_rating(DeliveryAgent, review.delivery_agent_id, rating - review.rating, 0)
+            review.rating = rating
         if 'comment' in data:
             review.comment = data['comment']
         
         db.session.commit()
         
-        # Update delivery agent average rating
-        update_delivery_agent_rating(old_agent_id)
-        
         return make_response({'message': 'Review updated', 'review': {
             'id': review.id,
             'rating': review.rating,
@@ -1603,15 +1967,12 @@ class CustomerDeliveryReviewById(Resource):
         if not review or review.customer_id != customer_id:
             return make_response({'error': 'Review not found'}, 404)
 
-        # Store agent_id before deletion
-        agent_id = review.delivery_agent_id
+        # Update delivery agent average rating in the same transaction
+        adjust_rating(DeliveryAgent, review.delivery_agent_id, -review.rating, -1)
         
         db.session.delete(review)
         db.session.commit()
         
-        # Update delivery agent average rating
-        update_delivery_agent_rating(agent_id)
-        
         return make_response({'message': 'Review deleted'}, 200)
     
     
@@ -1623,36 +1984,32 @@ class CustomerAllReviews(Resource):
         customer_id = session.get('user_id')
         reviews = []
         
-        # Get restaurant reviews
-        restaurant_reviews = RestaurantReview.query.filter_by(customer_id=customer_id).all()
+        # Get restaurant reviews, joining in the restaurant names
+        restaurant_reviews = RestaurantReview.query.options(
+            joinedload(RestaurantReview.restaurant).load_only(Restaurant.name)
+        ).filter_by(customer_id=customer_id)
         for r in restaurant_reviews:
-            restaurant = Restaurant.query.get(r.restaurant_id)
             reviews.append({
-                'id': r.id,
+                **review_summary(r),
                 'type': 'restaurant',
-                'comment': r.comment,
-                'rating': r.rating,
-                'created_at': r.created_at.isoformat() if r.created_at else None,
                 'target_id': r.restaurant_id,
-                'target_name': restaurant.name if restaurant else 'Unknown Restaurant'
+                'target_name': r.restaurant.name if r.restaurant else 'Unknown Restaurant'
             })
         
-        # Get delivery agent reviews
-        delivery_reviews = DeliveryReview.query.filter_by(customer_id=customer_id).all()
+        # Get delivery agent reviews, joining in the agent names
+        delivery_reviews = DeliveryReview.query.options(
+            joinedload(DeliveryReview.delivery_agent).load_only(DeliveryAgent.name)
+        ).filter_by(customer_id=customer_id)
         for r in delivery_reviews:
-            agent = DeliveryAgent.query.get(r.delivery_agent_id)
             reviews.append({
-                'id': r.id,
+                **review_summary(r),
                 'type': 'agent',
-                'comment': r.comment,
-                'rating': r.rating,
-                'created_at': r.created_at.isoformat() if r.created_at else None,
                 'target_id': r.delivery_agent_id,
-                'target_name': agent.name if agent else 'Unknown Agent'
+                'target_name': r.delivery_agent.name if r.delivery_agent else 'Unknown Agent'
             })
         
         # Sort by date, newest first
-        reviews.sort(key=lambda x: x.get('created_at', ''), reverse=True)
+        reviews.sort(key=lambda x: x['created_at'] or '', reverse=True)
         
         return make_response(reviews, 200)
 
@@ -1663,17 +2020,16 @@ class CustomerStats(Resource):
         
         customer_id = session.get('user_id')
         
-        # Get total restaurants count
-        total_restaurants = Restaurant.query.count()
-        
-        # Get all orders for the customer
-        orders = Order.query.filter_by(customer_id=customer_id).all()
-        
-        # Count delivered orders (those with delivery_time set)
-        delivered_orders = sum(1 for o in orders if o.delivery_time is not None)
+        # Get total restaurants count from the cached platform stats
+        total_restaurants = response_cache.get_or_set(
+            'platform_counts', ('restaurants', 'customers', 'delivery_agents'), platform_counts
+        )['restaurants']
         
-        # Count pending orders (those with null delivery_time)
-        pending_orders = sum(1 for o in orders if o.delivery_time is None)
+        # Count delivered orders (delivery_time set) and pending orders (null delivery_time) in one query
+        delivered_orders, pending_orders = db.session.query(
+            db.func.count(Order.delivery_time),
+            db.func.count(Order.id) - db.func.count(Order.delivery_time)
+        ).filter(Order.customer_id == customer_id).one()
         
         return make_response({
             'total_restaurants': total_restaurants,
@@ -1725,13 +2081,7 @@ class DeliveryAgentAccount(Resource):
         
         return make_response({
             'message': 'Delivery agent updated',
-            'id': agent.id,
-            'name': agent.name,
-            'email': agent.email,
-            'contact': agent.contact,
-            'image': agent.image,
-            'rating': agent.rating,
-            'restaurant_id': agent.restaurant_id
+            **agent.to_dict()
         }, 200)
 
 
@@ -1741,19 +2091,7 @@ class DeliveryAgentOrders(Resource):
             return make_response({'error': 'Unauthorized'}, 403)
         
         agent_id = session.get('user_id')
-        orders = Order.query.filter_by(delivery_agent_id=agent_id).all()
-        
-        return make_response([{
-            'id': o.id,
-            'created_at': o.created_at.isoformat() if o.created_at else None,
-            'delivery_time': o.delivery_time.isoformat() if o.delivery_time else None,
-            'delivery_address': o.delivery_address,
-            'payment_status': o.payment_status,
-            'total_price': o.total_price,
-            'restaurant_id': o.restaurant_id,
-            'delivery_agent_id': o.delivery_agent_id,
-            'customer_id': o.customer_id
-        } for o in orders], 200)
+        return order_listing(Order.query.filter_by(delivery_agent_id=agent_id))
 
 
 class DeliveryAgentPendingOrders(Resource):
@@ -1763,62 +2101,10 @@ class DeliveryAgentPendingOrders(Resource):
         
         agent_id = session.get('user_id')
         # Get orders where delivery_time is None (pending deliveries)
-        orders = Order.query.filter(
+        return order_listing(Order.query.filter(
             Order.delivery_agent_id == agent_id,
             Order.delivery_time.is_(None)
-        ).all()
-        
-        result = []
-        for o in orders:
-            # Get customer details
-            customer = o.customer
-            customer_data = None
-            if customer:
-                customer_data = {
-                    'id': customer.id,
-                    'name': customer.name,
-                    'image': customer.image,
-                    'contact': customer.contact
-                }
-            
-            # Get restaurant details
-            restaurant = o.restaurant
-            restaurant_data = None
-            if restaurant:
-                restaurant_data = {
-                    'id': restaurant.id,
-                    'name': restaurant.name,
-                    'logo': restaurant.logo
-                }
-            
-            # Build menu items list with quantities from OrderMenuItem
-            menu_items = []
-            for order_item in o.order_menu_items:
-                menu_item = order_item.menu_item
-                menu_items.append({
-                    'id': menu_item.id,
-                    'name': menu_item.name,
-                    'unit_price': menu_item.unit_price,
-                    'image': menu_item.image,
-                    'quantity': order_item.quantity
-                })
-            
-            result.append({
-                'id': o.id,
-                'created_at': o.created_at.isoformat() if o.created_at else None,
-                'delivery_time': None,
-                'delivery_address': o.delivery_address,
-                'payment_status': o.payment_status,
-                'total_price': o.total_price,
-                'restaurant_id': o.restaurant_id,
-                'delivery_agent_id': o.delivery_agent_id,
-                'customer_id': o.customer_id,
-                'customer': customer_data,
-                'restaurant': restaurant_data,
-                'menu_items': menu_items
-            })
-        
-        return make_response(result, 200)
+        ), ('customer', 'restaurant', 'menu_items'))
 
 
 class DeliveryAgentDeliveredOrders(Resource):
@@ -1828,51 +2114,10 @@ class DeliveryAgentDeliveredOrders(Resource):
         
         agent_id = session.get('user_id')
         # Get orders where delivery_time is not None (delivered orders)
-        orders = Order.query.filter(
+        return order_listing(Order.query.filter(
             Order.delivery_agent_id == agent_id,
             Order.delivery_time.isnot(None)
-        ).all()
-        
-        result = []
-        for o in orders:
-            # Get customer details
-            customer = o.customer
-            customer_data = None
-            if customer:
-                customer_data = {
-                    'id': customer.id,
-                    'name': customer.name,
-                    'image': customer.image,
-                    'contact': customer.contact
-                }
-            
-            # Build menu items list with quantities from OrderMenuItem
-            menu_items = []
-            for order_item in o.order_menu_items:
-                menu_item = order_item.menu_item
-                menu_items.append({
-                    'id': menu_item.id,
-                    'name': menu_item.name,
-                    'unit_price': menu_item.unit_price,
-                    'image': menu_item.image,
-                    'quantity': order_item.quantity
-                })
-            
-            result.append({
-                'id': o.id,
-                'created_at': o.created_at.isoformat() if o.created_at else None,
-                'delivery_time': o.delivery_time.isoformat() if o.delivery_time else None,
-                'delivery_address': o.delivery_address,
-                'payment_status': o.payment_status,
-                'total_price': o.total_price,
-                'restaurant_id': o.restaurant_id,
-                'delivery_agent_id': o.delivery_agent_id,
-                'customer_id': o.customer_id,
-                'customer': customer_data,
-                'menu_items': menu_items
-            })
-        
-        return make_response(result, 200)
+        ), ('customer', 'menu_items'))
 
 
 class DeliveryAgentReviews(Resource):
@@ -1881,16 +2126,9 @@ class DeliveryAgentReviews(Resource):
             return make_response({'error': 'Unauthorized'}, 403)
         
         agent_id = session.get('user_id')
-        reviews = DeliveryReview.query.filter_by(delivery_agent_id=agent_id).all()
+        reviews, next_cursor = paginate(DeliveryReview.query.filter_by(delivery_agent_id=agent_id), DeliveryReview)
         
-        return make_response([{
-            'id': r.id,
-            'comment': r.comment,
-            'rating': r.rating,
-            'created_at': r.created_at.isoformat() if r.created_at else None,
-            'delivery_agent_id': r.delivery_agent_id,
-            'customer_id': r.customer_id
-        } for r in reviews], 200)
+        return page_response([r.to_dict() for r in reviews], next_cursor)
 
 
 class DeliveryAgentOrderById(Resource):
@@ -1916,13 +2154,17 @@ class DeliveryAgentOrderById(Resource):
         try:
             # Parse ISO format datetime string
             delivery_time = datetime.fromisoformat(delivery_time_str.replace('Z', '+00:00'))
-            # Convert to timezone-aware datetime if needed
-            if delivery_time.tzinfo is None:
-                delivery_time = pytz.timezone('Africa/Nairobi').localize(delivery_time)
-            order.delivery_time = delivery_time
+            # Clients send UTC (toISOString); store naive Nairobi wall-clock time like every other timestamp
+            delivery_time = local_time(delivery_time).replace(tzinfo=None)
         except (ValueError, AttributeError) as e:
             return make_response({'error': f'Invalid delivery_time format: {str(e)}'}, 400)
         
+        # Move the order's delivery in the rollup from any earlier delivery time to the new one
+        if order.delivery_time:
+            adjust_delivery_stats(order, order.delivery_time, sign=-1)
+        adjust_delivery_stats(order, delivery_time)
+        order.delivery_time = delivery_time
+        
         db.session.commit()
         
         return make_response({
@@ -1932,20 +2174,13 @@ class DeliveryAgentOrderById(Resource):
 
 
 class DeliveryAgentById(Resource):
+    @response_cache.cached('delivery_agents')
     def get(self, id):
         agent = DeliveryAgent.query.get(id)
         if not agent:
             return make_response({'error': 'Delivery agent not found'}, 404)
         
-        return make_response({
-            'id': agent.id,
-            'name': agent.name,
-            'email': agent.email,
-            'contact': agent.contact,
-            'image': agent.image,
-            'rating': agent.rating,
-            'restaurant_id': agent.restaurant_id
-        }, 200)
+        return make_response(agent.to_dict(), 200)
 
 api.add_resource(DeliveryAgentAccount, '/api/agent/account')
 api.add_resource(DeliveryAgentOrders, '/api/agent/orders')
@@ -1966,18 +2201,74 @@ class UploadImage(Resource):
             return make_response({'error': 'No file selected'}, 400)
         
         if file:
-            # Generate unique filename
-            import uuid
-            filename = f"{uuid.uuid4()}{os.path.splitext(file.filename)[1]}"
-            filepath = os.path.join(UPLOAD_FOLDER, filename)
-            file.save(filepath)
+            # Store the rendition saved in image/logo fields now and leave the others to the job worker
+            name = new_image_name()
+            source = os.path.join(PENDING_UPLOAD_FOLDER, name)
+            file.save(source)
+            try:
+                save_renditions(source, UPLOAD_FOLDER, name, [DEFAULT_RENDITION])
+            except ValueError as e:
+                os.remove(source)
+                return make_response({'error': str(e)}, 400)
+            job_queue.enqueue('save_upload_renditions', {'name': name})
+            db.session.commit()
             
-            # Return the URL for the uploaded file
-            return make_response({'url': f'/uploads/{filename}'}, 200)
+            # url is the rendition to store in image/logo fields, the others are available once the job has run
+            renditions = rendition_urls(rendition_filenames(name))
+            return make_response({'url': renditions[DEFAULT_RENDITION], 'renditions': renditions}, 200)
 
 api.add_resource(UploadImage, '/api/upload')
 
+@job_queue.task()
+def save_upload_renditions(name):
+    """Store the renditions of an upload other than the one UploadImage saved, then drop its original"""
+    source = os.path.join(PENDING_UPLOAD_FOLDER, name)
+    if not os.path.exists(source):
+        return
+    save_renditions(source, UPLOAD_FOLDER, name, [rendition for rendition in rendition_filenames(name) if rendition != DEFAULT_RENDITION])
+    os.remove(source)
+
+# Columns holding uploaded image URLs
+IMAGE_COLUMNS = [Restaurant.logo, MenuItem.image, Customer.image, DeliveryAgent.image]
+
+@job_queue.task()
+def convert_upload(url):
+    """Store an upload saved before renditions existed as renditions and repoint every record using it"""
+    path = os.path.join(UPLOAD_FOLDER, os.path.basename(url))
+    if not os.path.exists(path):
+        return
+    try:
+        filenames = save_renditions(path, UPLOAD_FOLDER)
+    except ValueError:
+        # Not an image; retrying will not help, so leave the record as it is
+        return
+    new_url = rendition_urls(filenames)[DEFAULT_RENDITION]
+    for column in IMAGE_COLUMNS:
+        db.session.execute(db.update(column.class_).where(column == url).values({column: new_url}))
+
+@app.cli.command('convert-uploads')
+def convert_uploads_command():
+    """Queue jobs converting images uploaded before renditions existed."""
+    urls = set()
+    for column in IMAGE_COLUMNS:
+        urls.update(db.session.execute(db.select(column).where(column.like('/uploads/%')).distinct()).scalars())
+    legacy = sorted(url for url in urls if not is_rendition(url))
+    for url in legacy:
+        job_queue.enqueue('convert_upload', {'url': url}, key=f'convert_upload:{url}')
+    db.session.commit()
+    print(f'Found {len(legacy)} uploads to convert, run the job worker to process them')
+
 #7. M-Pesa Payment Routes
+# Seconds an STK prompt stays open on the customer's phone, no second prompt is sent for the order meanwhile
+STK_PROMPT_TIMEOUT = 90
+# Pushes without a callback after this many seconds are queried by reconcile_stk_requests...
+STK_QUERY_AFTER = 60
+# ...which gives up on them once they are this old
+STK_EXPIRE_AFTER = 15 * 60
+STK_RECONCILE_INTERVAL = 60
+# Seconds a run may spend spacing queries to MPESA_QUERY_RATE, it holds a job worker thread meanwhile
+STK_RECONCILE_QUERY_SECONDS = 5
+
 class MpesaSTKPush(Resource):
     def post(self):
         if session.get('user_type') != 'customer':
@@ -2000,14 +2291,8 @@ class MpesaSTKPush(Resource):
         if order.payment_status:
             return make_response({'error': 'Order already paid'}, 400)
         
-        # M-Pesa Configuration
-        mpesa_shortcode = os.getenv('MPESA_SHORTCODE', '')
-        mpesa_consumer_key = os.getenv('MPESA_CONSUMER_KEY', '')
-        mpesa_consumer_secret = os.getenv('MPESA_CONSUMER_SECRET', '')
-        mpesa_passkey = os.getenv('MPESA_PASSKEY', '')
-        
         # Check if M-Pesa credentials are configured
-        if not all([mpesa_shortcode, mpesa_consumer_key, mpesa_consumer_secret, mpesa_passkey]):
+        if not daraja.configured:
             # For demo purposes, simulate a successful STK push
             return make_response({
                 'message': 'M-Pesa STK push initiated. Check your phone to complete payment.',
@@ -2017,6 +2302,18 @@ class MpesaSTKPush(Resource):
                 'phone': phone
             }, 200)
         
+        # A prompt still open on the customer's phone is reused instead of sending another one
+        open_request = StkRequest.query.filter(
+            StkRequest.order_id == order.id,
+            StkRequest.status == 'pending',
+            StkRequest.created_at > utcnow() - timedelta(seconds=STK_PROMPT_TIMEOUT)
+        ).order_by(StkRequest.created_at.desc()).first()
+        if open_request:
+            return make_response({
+                'message': 'STK push already sent! Check your phone to complete payment.',
+                'checkout_request_id': open_request.checkout_request_id
+            }, 200)
+        
         # Format phone number (remove leading 0 if present)
         if phone.startswith('0'):
             phone = '254' + phone[1:]
@@ -2024,129 +2321,196 @@ class MpesaSTKPush(Resource):
             phone = phone[1:]
         
         try:
-            # Get access token
-            import base64
-            auth = base64.b64encode(f'{mpesa_consumer_key}:{mpesa_consumer_secret}'.encode()).decode()
-            
-            token_response = requests.get(
-                'https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials',
-                headers={'Authorization': f'Basic {auth}'}
-            )
-            
-            if token_response.status_code != 200:
-                return make_response({'error': 'Failed to get M-Pesa access token'}, 500)
-            
-            access_token = token_response.json().get('access_token')
-            
-            # Generate STK push request
-            import uuid
-            from datetime import datetime
-            
-            timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-            password = base64.b64encode(
-                f'{mpesa_shortcode}{mpesa_passkey}{timestamp}'.encode()
-            ).decode()
-            
-            stk_payload = {
-                'BusinessShortCode': mpesa_shortcode,
-                'Password': password,
-                'Timestamp': timestamp,
-                'TransactionType': 'CustomerBuyGoodsOnline',
-                'Amount': int(amount),
-                'PartyA': phone,
-                'PartyB': mpesa_shortcode,
-                'PhoneNumber': phone,
-                'CallBackURL': os.getenv('MPESA_CALLBACK_URL', ''),
-                'AccountReference': f'Order{order_id}',
-                'TransactionDesc': f'Payment for Order #{order_id}'
-            }
-            
-            stk_response = requests.post(
-                'https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest',
-                json=stk_payload,
-                headers={
-                    'Authorization': f'Bearer {access_token}',
-                    'Content-Type': 'application/json'
-                }
-            )
-            
-            if stk_response.status_code == 200:
-                return make_response({
-                    'message': 'STK push sent! Check your phone to complete payment.',
-                    'checkout_request_id': stk_response.json().get('CheckoutRequestID')
-                }, 200)
-            else:
-                return make_response({
-                    'error': 'Failed to initiate STK push',
-                    'details': stk_response.text
-                }, 500)
-                
+            stk_response = daraja.stk_push(phone, amount, f'Order{order_id}', f'Payment for Order #{order_id}')
+        except DarajaError as e:
+            return make_response({'error': str(e), 'details': e.details}, 500)
         except Exception as e:
             return make_response({'error': f'M-Pesa error: {str(e)}'}, 500)
+        
+        checkout_request_id = stk_response.get('CheckoutRequestID')
+        if checkout_request_id:
+            db.session.add(StkRequest(
+                checkout_request_id=checkout_request_id,
+                merchant_request_id=stk_response.get('MerchantRequestID'),
+                order_id=order.id,
+                customer_id=customer_id,
+                phone=phone,
+                amount=float(amount)
+            ))
+            db.session.commit()
+        
+        return make_response({
+            'message': 'STK push sent! Check your phone to complete payment.',
+            'checkout_request_id': checkout_request_id
+        }, 200)
+
+# Callback entries settled per transaction by apply_mpesa_callbacks
+MPESA_CALLBACK_BATCH_SIZE = 100
+# Callbacks received within this many seconds of each other are applied by the same job
+MPESA_CALLBACK_BATCH_WINDOW = 2
+
+# Helper function to read STK callback metadata
+def callback_item(callback, name):
+    """Return the value of the named CallbackMetadata item of an stkCallback, or None"""
+    for item in callback.get('CallbackMetadata', {}).get('Item', []):
+        if item.get('Name') == name:
+            return item.get('Value')
+    return None
+
+# Helper function to find the order an STK callback pays for
+def callback_order_id(callback, stk_request=None):
+    """Return the order id of the push the callback answers, else from its Order<id> account reference, or None"""
+    if stk_request is not None:
+        return stk_request.order_id
+    account_ref = str(callback_item(callback, 'AccountReference') or '')
+    order_id = account_ref.replace('Order', '')
+    return int(order_id) if order_id.isdigit() else None
+
+# Helper function to record the outcome of an STK push
+def finish_stk_request(stk_request, status, result_code, result_desc):
+    stk_request.status = status
+    stk_request.result_code = result_code
+    stk_request.result_desc = result_desc
+    stk_request.settled_at = utcnow()
+
+# Helper function to settle one stored callback
+def apply_mpesa_callback(entry, stk_request, orders):
+    """Record the payment for a successful callback and mark the entry and its push with the outcome"""
+    callback = entry.payload['Body']['stkCallback']
+    entry.processed_at = utcnow()
+    # A callback is the final word on its push, even one the reconciler already expired
+    if stk_request is not None:
+        finish_stk_request(stk_request, 'paid' if entry.result_code == 0 else 'failed', entry.result_code, callback.get('ResultDesc'))
+    if entry.result_code != 0:
+        # Cancelled by the customer, timed out or declined
+        entry.status = 'failed'
+        entry.note = callback.get('ResultDesc')
+        return
+    
+    order = orders.get(callback_order_id(callback, stk_request))
+    amount = callback_item(callback, 'Amount') or (order.total_price if order is not None else None)
+    if order is None or settle_order(order, amount, 'mpesa', entry.receipt_number) is None:
+        entry.status = 'ignored'
+        entry.note = 'Order not found' if order is None else 'Order already paid'
+        return
+    entry.status = 'paid'
+
+@job_queue.task(every=60)
+def apply_mpesa_callbacks():
+    """Settle pending M-Pesa callbacks, committing each batch. The interval run picks up anything a failed run left behind."""
+    while True:
+        query = MpesaCallbackEntry.query.filter_by(status='pending').order_by(MpesaCallbackEntry.id).limit(MPESA_CALLBACK_BATCH_SIZE)
+        if db.engine.dialect.name == 'postgresql':
+            query = query.with_for_update(skip_locked=True)
+        entries = query.all()
+        if not entries:
+            return
+        stk_requests = {
+            stk_request.checkout_request_id: stk_request
+            for stk_request in StkRequest.query.filter(StkRequest.checkout_request_id.in_([entry.checkout_request_id for entry in entries]))
+        }
+        order_ids = {
+            callback_order_id(entry.payload['Body']['stkCallback'], stk_requests.get(entry.checkout_request_id))
+            for entry in entries
+        }
+        orders = {order.id: order for order in Order.query.filter(Order.id.in_(order_ids - {None}))}
+        for entry in entries:
+            apply_mpesa_callback(entry, stk_requests.get(entry.checkout_request_id), orders)
+        db.session.commit()
+
+# Helper function to apply Safaricom's current result to one pending push
+def reconcile_stk_request(stk_request, now):
+    """Query a push and mark it paid, failed or (once too old) expired; leave it pending while there is no result"""
+    try:
+        result = daraja.stk_query(stk_request.checkout_request_id)
+        result_code = int(result['ResultCode'])
+    except (DarajaError, RequestException, KeyError, ValueError):
+        # Still being processed, rate limited or unreachable: try again on a later run
+        result_code = None
+    
+    stk_request.checked_at = utcnow()
+    if result_code == 0:
+        # SQLite does not enforce the cascade, so the order may have been deleted since the push
+        order = db.session.get(Order, stk_request.order_id)
+        if order is None:
+            finish_stk_request(stk_request, 'failed', result_code, 'Paid, but the order no longer exists')
+            return
+        settle_order(order, stk_request.amount, 'mpesa')
+        finish_stk_request(stk_request, 'paid', result_code, result.get('ResultDesc'))
+    elif result_code is not None:
+        finish_stk_request(stk_request, 'failed', result_code, result.get('ResultDesc'))
+    elif stk_request.created_at <= now - timedelta(seconds=STK_EXPIRE_AFTER):
+        finish_stk_request(stk_request, 'expired', None, 'No result from M-Pesa')
+
+@job_queue.task(every=STK_RECONCILE_INTERVAL)
+def reconcile_stk_requests():
+    """Ask Safaricom for the outcome of pushes whose callback has not arrived, settling or expiring them.
+    Queries are spaced to MPESA_QUERY_RATE, as many as fit in STK_RECONCILE_QUERY_SECONDS per run, and each
+    push is committed on its own. The oldest pushes go first; the rest wait for later runs."""
+    if not daraja.configured:
+        return
+    now = utcnow()
+    batch_size = max(1, int(STK_RECONCILE_QUERY_SECONDS * MPESA_QUERY_RATE))
+    stale = StkRequest.query.filter(
+        StkRequest.status == 'pending',
+        StkRequest.created_at <= now - timedelta(seconds=STK_QUERY_AFTER),
+        db.or_(StkRequest.checked_at.is_(None), StkRequest.checked_at <= now - timedelta(seconds=STK_RECONCILE_INTERVAL))
+    ).order_by(StkRequest.created_at).limit(batch_size).all()
+    
+    next_query = 0
+    for stk_request in stale:
+        time.sleep(max(0, next_query - time.monotonic()))
+        next_query = time.monotonic() + 1 / MPESA_QUERY_RATE
+        stk_request_id = stk_request.id
+        try:
+            reconcile_stk_request(stk_request, now)
+            db.session.commit()
+        except Exception:
+            # One bad push must not stop the run, and is only retried after the others have had their turn
+            db.session.rollback()
+            app.logger.exception('Failed to reconcile STK request %s', stk_request_id)
+            StkRequest.query.filter_by(id=stk_request_id).update({'checked_at': utcnow()})
+            db.session.commit()
 
 class MpesaCallback(Resource):
     def post(self):
-        """Handle M-Pesa callback for STK push"""
-        data = request.get_json()
-        
-        # Process callback data
-        try:
-            result = data.get('Body', {}).get('stkCallback', {})
-            result_code = result.get('ResultCode')
-            result_desc = result.get('ResultDesc')
-            
-            if result_code == 0:
-                # Payment successful
-                callback_metadata = result.get('CallbackMetadata', {})
-                amount = 0
-                phone = ''
-                transaction_id = ''
-                
-                for item in callback_metadata.get('Item', []):
-                    if item.get('Name') == 'Amount':
-                        amount = item.get('Value')
-                    elif item.get('Name') == 'PhoneNumber':
-                        phone = item.get('Value')
-                    elif item.get('Name') == 'MpesaReceiptNumber':
-                        transaction_id = item.get('Value')
-                
-                # Find and update the order
-                # The order is identified by AccountReference in the request
-                account_ref = result.get('Item', [{}])[1].get('Value', '')
-                order_id = int(account_ref.replace('Order', ''))
-                
-                order = Order.query.get(order_id)
-                if order and not order.payment_status:
-                    order.payment_status = True
-                    
-                    payment = Payment(
-                        order_id=order_id,
-                        customer_id=order.customer_id,
-                        restaurant_id=order.restaurant_id,
-                        amount=amount,
-                        method='mpesa',
-                        transaction_id=transaction_id
-                    )
-                    db.session.add(payment)
-                    db.session.commit()
-                    
-                    return make_response({'message': 'Payment processed'}, 200)
-            else:
-                # Payment failed
-                return make_response({'error': result_desc}, 400)
-                                               
-        except Exception as e:
-            return make_response({'error': f'Callback processing error: {str(e)}'}, 500)
+        """Store an M-Pesa STK callback and acknowledge it at once; apply_mpesa_callbacks settles it"""
+        data = request.get_json(silent=True)
+        callback = data.get('Body', {}).get('stkCallback', {}) if isinstance(data, dict) else {}
+        checkout_request_id = callback.get('CheckoutRequestID')
+        result_code = callback.get('ResultCode')
+        if not checkout_request_id or not str(result_code).isdigit():
+            return make_response({'error': 'Invalid callback'}, 400)
+        
+        insert = postgresql_insert if db.engine.dialect.name == 'postgresql' else sqlite_insert
+        stored = db.session.execute(insert(MpesaCallbackEntry).values(
+            checkout_request_id=checkout_request_id,
+            receipt_number=callback_item(callback, 'MpesaReceiptNumber'),
+            result_code=int(result_code),
+            payload=data
+        ).on_conflict_do_nothing())
+        # A resent callback is already stored and queued
+        if stored.rowcount:
+            window = int(time.time() // MPESA_CALLBACK_BATCH_WINDOW)
+            job_queue.enqueue('apply_mpesa_callbacks', delay=MPESA_CALLBACK_BATCH_WINDOW, key=f'mpesa_callbacks:{window}')
+        db.session.commit()
         
-        return make_response({'message': 'Callback received'}, 200)
+        # Daraja's acknowledgement format, Safaricom keeps resending callbacks until it gets one
+        return make_response({'ResultCode': 0, 'ResultDesc': 'Accepted'}, 200)
 
 api.add_resource(MpesaSTKPush, '/api/payments/mpesa/stkpush')
 api.add_resource(MpesaCallback, '/api/payments/mpesa/callback')
 
 # Serve uploaded files
+# Every upload gets a new filename and is never rewritten, so clients may cache them indefinitely
+UPLOAD_MAX_AGE = 365 * 24 * 3600
+
 @app.route('/uploads/<filename>')
 def serve_upload(filename):
-    return send_from_directory(UPLOAD_FOLDER, filename)
+    response = send_from_directory(UPLOAD_FOLDER, filename, max_age=UPLOAD_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 if __name__ == '__main__':
     app.run(port=5555, debug=True)
\ No newline at end of file
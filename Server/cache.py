@@ -0,0 +1,270 @@
+import functools
+import hashlib
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import request, Response
+from sqlalchemy import event, inspect
+
+
+class MemoryCacheBackend:
+    """LRU cache held in the current process. Invalidations are only seen by this worker."""
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.tag_generations = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, generations, expires_at = entry
+            if expires_at <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value, generations
+
+    def set(self, key, value, generations, ttl):
+        with self.lock:
+            self.entries[key] = (value, generations, time.time() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def generations(self, tags):
+        with self.lock:
+            return {tag: self.tag_generations.get(tag, 0) for tag in tags}
+
+    def bump(self, tags):
+        with self.lock:
+            for tag in tags:
+                self.tag_generations[tag] = self.tag_generations.get(tag, 0) + 1
+
+
+class SQLiteCacheBackend:
+    """LRU cache stored in a local SQLite file so every gunicorn worker on the host shares entries and invalidations."""
+
+    def __init__(self, path, max_entries=1000):
+        self.path = path
+        self.max_entries = max_entries
+        self.local = threading.local()
+        with self.connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS cache_entries ('
+                         'key TEXT PRIMARY KEY, value TEXT NOT NULL, generations TEXT NOT NULL, '
+                         'expires_at REAL NOT NULL, used_at REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_cache_entries_used_at ON cache_entries (used_at)')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache_generations ('
+                         'tag TEXT PRIMARY KEY, generation INTEGER NOT NULL)')
+
+    def connection(self):
+        # sqlite3 connections cannot be shared between threads, so keep one per thread
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self.connection()
+        now = time.time()
+        row = conn.execute('SELECT value, generations, expires_at FROM cache_entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        if row[2] <= now:
+            conn.execute('DELETE FROM cache_entries WHERE key = ?', (key,))
+            return None
+        conn.execute('UPDATE cache_entries SET used_at = ? WHERE key = ?', (now, key))
+        return json.loads(row[0]), json.loads(row[1])
+
+    def set(self, key, value, generations, ttl):
+        conn = self.connection()
+        now = time.time()
+        conn.execute('INSERT OR REPLACE INTO cache_entries (key, value, generations, expires_at, used_at) '
+                     'VALUES (?, ?, ?, ?, ?)',
+                     (key, json.dumps(value), json.dumps(generations), now + ttl, now))
+        # Drop expired entries, then the least recently used ones beyond max_entries
+        conn.execute('DELETE FROM cache_entries WHERE expires_at <= ?', (now,))
+        conn.execute('DELETE FROM cache_entries WHERE key IN ('
+                     'SELECT key FROM cache_entries ORDER BY used_at DESC LIMIT -1 OFFSET ?)',
+                     (self.max_entries,))
+
+    def generations(self, tags):
+        tags = list(tags)
+        rows = self.connection().execute(
+            f'SELECT tag, generation FROM cache_generations WHERE tag IN ({", ".join("?" * len(tags))})', tags
+        ).fetchall()
+        found = dict(rows)
+        return {tag: found.get(tag, 0) for tag in tags}
+
+    def bump(self, tags):
+        self.connection().executemany(
+            'INSERT INTO cache_generations (tag, generation) VALUES (?, 1) '
+            'ON CONFLICT(tag) DO UPDATE SET generation = generation + 1',
+            [(tag,) for tag in tags]
+        )
+
+
+class ResponseCache:
+    """TTL cache for read-heavy endpoints, invalidated per table when a transaction touching that table commits.
+
+    Every entry records the generation of each tag it was built from; writing to a table bumps its
+    generation so older entries stop matching. Tables listed in scopes also get one tag per value of
+    the scope column (e.g. 'menu_items:3' for restaurant 3's menu), plus a 'menu_items:*' tag bumped by
+    bulk statements whose rows are unknown.
+    """
+
+    def __init__(self, backend, ttl=60, scopes=None):
+        self.backend = backend
+        self.ttl = ttl
+        self.scopes = scopes or {}
+
+    def get_or_set(self, key, tags, loader):
+        """Return the cached value for key, calling loader to rebuild it when missing, stale or invalidated"""
+        if self.ttl <= 0:
+            return loader()
+        entry = self.backend.get(key)
+        generations = self.backend.generations(tags)
+        if entry is not None and entry[1] == generations:
+            return entry[0]
+        # Generations are read before loading, so a write racing the load leaves the entry already stale
+        value = loader()
+        self.backend.set(key, value, generations, self.ttl)
+        return value
+
+    def invalidate(self, tags):
+        """Mark every entry built from any of the given tables as stale"""
+        self.backend.bump(sorted(tags))
+
+    def resolve_tags(self, tags):
+        """Fill scoped tags such as 'menu_items:{restaurant_id}' from the URL and query string"""
+        values = {name: self.scope_value(value) for name, value in {**request.args.to_dict(), **(request.view_args or {})}.items()}
+        resolved = []
+        for tag in tags:
+            if '{' in tag:
+                tag = tag.format(**values)
+                resolved.append(tag.split(':', 1)[0] + ':*')
+            resolved.append(tag)
+        return resolved
+
+    @staticmethod
+    def scope_value(value):
+        """Normalize an id from the URL to the form writes are tagged with, so ?restaurant_id=01 shares the tag of 1"""
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return value
+
+    @staticmethod
+    def etag(body):
+        """Strong ETag for a response body"""
+        return hashlib.sha1(body.encode()).hexdigest()
+
+    def cached(self, *tags, conditional=False):
+        """Decorator caching a Resource method's successful responses by request path and query string.
+        With conditional=True responses carry an ETag hashed from the body, and a matching If-None-Match
+        gets a 304, without running the method while the response is cached.
+        """
+        def decorator(method):
+            @functools.wraps(method)
+            def wrapper(*args, **kwargs):
+                try:
+                    resolved_tags = self.resolve_tags(tags)
+                except KeyError:
+                    # A scope parameter is missing, let the method report the bad request
+                    return method(*args, **kwargs)
+                key = f'response:{request.full_path}'
+                generations = self.backend.generations(resolved_tags)
+                
+                entry = self.backend.get(key) if self.ttl > 0 else None
+                if entry is not None and entry[1] == generations:
+                    cached_response = entry[0]
+                else:
+                    response = method(*args, **kwargs)
+                    if response.status_code != 200:
+                        return response
+                    body = response.get_data(as_text=True)
+                    cached_response = {'body': body, 'mimetype': response.mimetype, 'etag': self.etag(body)}
+                    if self.ttl > 0:
+                        self.backend.set(key, cached_response, generations, self.ttl)
+                
+                if not conditional:
+                    return Response(cached_response['body'], status=200, mimetype=cached_response['mimetype'])
+                # The ETag belongs to the body being served, so it never validates content the client does not have,
+                # even while a write made through another worker has not reached this cache yet
+                etag = cached_response.get('etag') or self.etag(cached_response['body'])
+                if request.if_none_match.contains_weak(etag):
+                    return self.revalidation_headers(Response(status=304), etag)
+                response = Response(cached_response['body'], status=200, mimetype=cached_response['mimetype'])
+                return self.revalidation_headers(response, etag)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def revalidation_headers(response, etag):
+        """Let clients store the response but revalidate it with its ETag before reuse"""
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.no_cache = True
+        return response
+
+    def watch(self, session):
+        """Invalidate the tables written through session once each transaction commits"""
+        def pending_tags(session):
+            return session.info.setdefault('response_cache_tags', set())
+
+        @event.listens_for(session, 'after_flush')
+        def collect_flushed(session, flush_context):
+            for obj in itertools.chain(session.new, session.dirty, session.deleted):
+                table_name = getattr(obj, '__tablename__', None)
+                if not table_name:
+                    continue
+                tags = pending_tags(session)
+                tags.add(table_name)
+                scope = self.scopes.get(table_name)
+                if scope:
+                    # Tag both the current scope value and any value it was moved away from
+                    history = inspect(obj).attrs[scope].history
+                    for value in itertools.chain(history.unchanged or (), history.added or (), history.deleted or ()):
+                        tags.add(f'{table_name}:{value}')
+
+        @event.listens_for(session, 'do_orm_execute')
+        def collect_bulk_statements(orm_execute_state):
+            # Query.update(), db.update(Model) and bulk inserts bypass the flush
+            if orm_execute_state.is_select or orm_execute_state.bind_mapper is None:
+                return
+            table_name = orm_execute_state.bind_mapper.local_table.name
+            tags = pending_tags(orm_execute_state.session)
+            tags.add(table_name)
+            if table_name in self.scopes:
+                tags.add(f'{table_name}:*')
+
+        @event.listens_for(session, 'after_commit')
+        def invalidate_committed(session):
+            tags = session.info.pop('response_cache_tags', None)
+            if tags:
+                self.invalidate(tags)
+
+        @event.listens_for(session, 'after_rollback')
+        def discard_rolled_back(session):
+            session.info.pop('response_cache_tags', None)
+
+
+def create_cache_backend(name, path, max_entries):
+    """Build the cache backend named by RESPONSE_CACHE_BACKEND ('memory' or 'sqlite')"""
+    if name == 'sqlite':
+        return SQLiteCacheBackend(path, max_entries)
+    if name == 'memory':
+        return MemoryCacheBackend(max_entries)
+    raise ValueError(f'Unknown response cache backend: {name}')
@@ -0,0 +1,71 @@
+import gzip
+
+from flask import request
+
+# brotli is optional; without it responses are only ever gzipped
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class ResponseCompressor:
+    """Compresses responses larger than min_size with brotli or gzip, as allowed by the request's Accept-Encoding.
+
+    Images other than SVG are already compressed and are left alone, as are streamed and partial responses.
+    """
+
+    def __init__(self, min_size=1024, gzip_level=6, brotli_quality=4):
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def init_app(self, app):
+        app.after_request(self.compress)
+
+    def choose_encoding(self):
+        """Return the best encoding the client accepts, or None to send the response as is"""
+        accepted = request.accept_encodings
+        if brotli is not None and accepted['br'] > 0:
+            return 'br'
+        if accepted['gzip'] > 0:
+            return 'gzip'
+        return None
+
+    def compressible(self, response):
+        if response.status_code < 200 or response.status_code in (204, 206, 304):
+            return False
+        if 'Content-Encoding' in response.headers:
+            return False
+        # Files from send_from_directory are wrapped for passthrough and can still be read whole;
+        # any other streamed body is generated lazily and is sent as is
+        if response.is_streamed and not response.direct_passthrough:
+            return False
+        mimetype = response.mimetype or ''
+        return not mimetype.startswith('image/') or mimetype == 'image/svg+xml'
+
+    def compress(self, response):
+        if not self.compressible(response):
+            return response
+        # Caches must key on Accept-Encoding even when this client gets the uncompressed body
+        response.vary.add('Accept-Encoding')
+        encoding = self.choose_encoding()
+        if encoding is None:
+            return response
+
+        response.direct_passthrough = False
+        data = response.get_data()
+        if len(data) < self.min_size:
+            return response
+
+        if encoding == 'br':
+            data = brotli.compress(data, quality=self.brotli_quality)
+        else:
+            data = gzip.compress(data, compresslevel=self.gzip_level, mtime=0)
+        response.set_data(data)
+        response.headers['Content-Encoding'] = encoding
+        # The compressed bytes are a different representation, so only weak validation still holds
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
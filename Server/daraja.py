@@ -0,0 +1,126 @@
+import base64
+import threading
+import time
+from datetime import datetime
+
+import pytz
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class DarajaError(Exception):
+    """A Daraja API call returned an error response"""
+
+    def __init__(self, message, status_code=None, details=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.details = details
+
+
+class DarajaClient:
+    """Safaricom Daraja (M-Pesa) API client safe to share between threads.
+
+    Calls go through one pooled requests.Session with keep-alive and strict connect/read timeouts.
+    The OAuth token is cached and refreshed shortly before it expires, so a checkout normally
+    makes a single request to Safaricom.
+    """
+
+    def __init__(self, base_url, consumer_key, consumer_secret, shortcode, passkey, callback_url,
+                 connect_timeout=3.05, read_timeout=10, pool_size=10, token_margin=60):
+        self.base_url = base_url.rstrip('/')
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.shortcode = shortcode
+        self.passkey = passkey
+        self.callback_url = callback_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.token_margin = token_margin
+        self.token = None
+        self.token_expires_at = 0
+        self.token_lock = threading.Lock()
+
+        self.session = requests.Session()
+        # Only connection failures are retried: a request that may have reached Safaricom is never resent
+        retry = Retry(total=2, connect=2, read=0, status=0, other=0, backoff_factor=0.2)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    @property
+    def configured(self):
+        return all([self.shortcode, self.consumer_key, self.consumer_secret, self.passkey])
+
+    def access_token(self):
+        """Return a valid OAuth token, fetching a new one when the cached token is about to expire"""
+        # Holding the lock while fetching means concurrent requests wait for one refresh instead of each making their own
+        with self.token_lock:
+            if self.token is None or time.monotonic() >= self.token_expires_at - self.token_margin:
+                response = self.session.get(
+                    f'{self.base_url}/oauth/v1/generate',
+                    params={'grant_type': 'client_credentials'},
+                    auth=(self.consumer_key, self.consumer_secret),
+                    timeout=self.timeout
+                )
+                if response.status_code != 200:
+                    raise DarajaError('Failed to get M-Pesa access token', response.status_code, response.text)
+                body = response.json()
+                self.token = body['access_token']
+                self.token_expires_at = time.monotonic() + int(body.get('expires_in', 3599))
+            return self.token
+
+    def post(self, path, payload):
+        """POST payload to an API path with the cached token, refreshing it once if Safaricom rejects it"""
+        for attempt in range(2):
+            token = self.access_token()
+            response = self.session.post(
+                f'{self.base_url}{path}',
+                json=payload,
+                headers={'Authorization': f'Bearer {token}'},
+                timeout=self.timeout
+            )
+            if response.status_code != 401 or attempt:
+                return response
+            # The token was revoked before its expiry, drop it so the retry fetches a new one
+            with self.token_lock:
+                if self.token == token:
+                    self.token = None
+
+    def password(self):
+        """Return the (password, timestamp) pair that authenticates STK requests"""
+        timestamp = datetime.now(pytz.timezone('Africa/Nairobi')).strftime('%Y%m%d%H%M%S')
+        password = base64.b64encode(f'{self.shortcode}{self.passkey}{timestamp}'.encode()).decode()
+        return password, timestamp
+
+    def stk_push(self, phone, amount, account_reference, description):
+        """Send an STK push prompt to phone and return Safaricom's response body"""
+        password, timestamp = self.password()
+        response = self.post('/mpesa/stkpush/v1/processrequest', {
+            'BusinessShortCode': self.shortcode,
+            'Password': password,
+            'Timestamp': timestamp,
+            'TransactionType': 'CustomerBuyGoodsOnline',
+            'Amount': int(amount),
+            'PartyA': phone,
+            'PartyB': self.shortcode,
+            'PhoneNumber': phone,
+            'CallBackURL': self.callback_url,
+            'AccountReference': account_reference,
+            'TransactionDesc': description
+        })
+        if response.status_code != 200:
+            raise DarajaError('Failed to initiate STK push', response.status_code, response.text)
+        return response.json()
+
+    def stk_query(self, checkout_request_id):
+        """Return Safaricom's current result for an STK push. Raises DarajaError while it has no result yet."""
+        password, timestamp = self.password()
+        response = self.post('/mpesa/stkpushquery/v1/query', {
+            'BusinessShortCode': self.shortcode,
+            'Password': password,
+            'Timestamp': timestamp,
+            'CheckoutRequestID': checkout_request_id
+        })
+        if response.status_code != 200:
+            raise DarajaError('Failed to query STK push status', response.status_code, response.text)
+        return response.json()
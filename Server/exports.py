@@ -0,0 +1,55 @@
+import csv
+import io
+from datetime import datetime
+
+from flask import Response, current_app, stream_with_context
+
+# Download formats supported by export endpoints and their content types
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def csv_chunks(rows, columns, batch_size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for count, row in enumerate(rows, 1):
+        writer.writerow([export_value(value) for value in row])
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def ndjson_chunks(rows, columns, batch_size):
+    dumps = current_app.json.dumps
+    lines = []
+    for row in rows:
+        lines.append(dumps({column: export_value(value) for column, value in zip(columns, row)}))
+        if len(lines) == batch_size:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def export_response(rows, columns, fmt, filename, batch_size=500):
+    """Stream rows (tuples ordered like columns) as a CSV or NDJSON download.
+
+    rows is consumed lazily while the response is sent, so pass a streaming result
+    (e.g. execution_options(yield_per=...)) to keep memory flat for any number of rows.
+    """
+    chunks = csv_chunks if fmt == 'csv' else ndjson_chunks
+    response = Response(
+        stream_with_context(chunks(rows, columns, batch_size)),
+        mimetype=EXPORT_FORMATS[fmt]
+    )
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}.{fmt}"'
+    return response
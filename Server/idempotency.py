@@ -0,0 +1,181 @@
+import functools
+import hashlib
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, make_response, request, session
+
+
+class MemoryIdempotencyStore:
+    """Idempotency records held in the current process, at most max_entries of them.
+
+    Records are kept in the order they were last written, which is not expiry order since claims and
+    stored responses have different lifetimes. An expired record is replaced when its key is reused;
+    otherwise the least recently written records are dropped once the store is full, expired or not.
+    Claims of requests still running are never dropped, so their retries keep getting 409.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def begin(self, key, fingerprint, lock_ttl):
+        """Claim key for a new request and return None, or return the existing (fingerprint, response) record"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] > now:
+                return entry[0], entry[1]
+            self.entries[key] = (fingerprint, None, now + lock_ttl)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_entries:
+                self.trim(now)
+            return None
+
+    def complete(self, key, fingerprint, response, ttl):
+        with self.lock:
+            self.entries[key] = (fingerprint, response, time.time() + ttl)
+            self.entries.move_to_end(key)
+
+    def release(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def trim(self, now):
+        excess = len(self.entries) - self.max_entries
+        droppable = (key for key, entry in self.entries.items() if entry[1] is not None or entry[2] <= now)
+        for key in list(itertools.islice(droppable, excess)):
+            del self.entries[key]
+
+
+class SQLiteIdempotencyStore:
+    """Idempotency records in a local SQLite file, shared by every gunicorn worker on the host.
+    At most every sweep_interval seconds expired records are deleted, then the least recently stored
+    responses beyond max_entries. Claims of requests still running are never trimmed."""
+
+    def __init__(self, path, max_entries=10000, sweep_interval=60):
+        self.path = path
+        self.max_entries = max_entries
+        self.sweep_interval = sweep_interval
+        self.next_sweep = 0
+        self.local = threading.local()
+        with self.connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS idempotency_keys ('
+                         'key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, response TEXT, expires_at REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_idempotency_keys_expires_at ON idempotency_keys (expires_at)')
+
+    def connection(self):
+        # sqlite3 connections cannot be shared between threads, so keep one per thread
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def begin(self, key, fingerprint, lock_ttl):
+        """Claim key for a new request and return None, or return the existing (fingerprint, response) record"""
+        conn = self.connection()
+        now = time.time()
+        if now >= self.next_sweep:
+            self.sweep(now)
+        conn.execute('DELETE FROM idempotency_keys WHERE key = ? AND expires_at <= ?', (key, now))
+        claimed = conn.execute('INSERT OR IGNORE INTO idempotency_keys (key, fingerprint, response, expires_at) '
+                               'VALUES (?, ?, NULL, ?)', (key, fingerprint, now + lock_ttl))
+        if claimed.rowcount == 1:
+            return None
+        row = conn.execute('SELECT fingerprint, response FROM idempotency_keys WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            # Swept by another worker in between, claim it again
+            return self.begin(key, fingerprint, lock_ttl)
+        return row[0], json.loads(row[1]) if row[1] is not None else None
+
+    def complete(self, key, fingerprint, response, ttl):
+        self.connection().execute('INSERT OR REPLACE INTO idempotency_keys (key, fingerprint, response, expires_at) '
+                                  'VALUES (?, ?, ?, ?)', (key, fingerprint, json.dumps(response), time.time() + ttl))
+
+    def release(self, key):
+        self.connection().execute('DELETE FROM idempotency_keys WHERE key = ?', (key,))
+
+    def sweep(self, now):
+        conn = self.connection()
+        conn.execute('DELETE FROM idempotency_keys WHERE expires_at <= ?', (now,))
+        # Deleting a claim would let a retry run the handler a second time, so only stored responses are trimmed
+        conn.execute('DELETE FROM idempotency_keys WHERE key IN ('
+                     'SELECT key FROM idempotency_keys WHERE response IS NOT NULL ORDER BY expires_at DESC '
+                     'LIMIT -1 OFFSET max(? - (SELECT COUNT(*) FROM idempotency_keys WHERE response IS NULL), 0))',
+                     (self.max_entries,))
+        self.next_sweep = now + self.sweep_interval
+
+
+class Idempotency:
+    """Idempotency-Key support for POST endpoints that create records.
+
+    The first request with a key runs the method; its successful response is stored for ttl seconds and
+    returned to every retry with the same key, user and body without running the method again. A retry
+    arriving while the first request is still running gets 409, and reusing a key for a different body
+    gets 422. Failed requests are not stored, so they can be retried with the same key.
+    """
+
+    def __init__(self, store, ttl=86400, lock_ttl=60, header='Idempotency-Key'):
+        self.store = store
+        self.ttl = ttl
+        self.lock_ttl = lock_ttl
+        self.header = header
+
+    def idempotent(self, method):
+        """Decorator applying Idempotency-Key handling to a Resource method"""
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            idempotency_key = request.headers.get(self.header)
+            if not idempotency_key:
+                return method(*args, **kwargs)
+            if len(idempotency_key) > 255:
+                return make_response({'error': f'{self.header} must be at most 255 characters'}, 400)
+
+            # Keys are only unique per client, so scope them to the user and endpoint
+            key = f"{session.get('user_type')}:{session.get('user_id')}:{request.method}:{request.path}:{idempotency_key}"
+            fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+            record = self.store.begin(key, fingerprint, self.lock_ttl)
+            if record is not None:
+                stored_fingerprint, stored_response = record
+                if stored_fingerprint != fingerprint:
+                    return make_response({'error': f'{self.header} was already used for a different request'}, 422)
+                if stored_response is None:
+                    return make_response({'error': f'A request with this {self.header} is still being processed'}, 409)
+                response = Response(stored_response['body'], status=stored_response['status'], mimetype=stored_response['mimetype'])
+                response.headers['Idempotent-Replayed'] = 'true'
+                return response
+
+            try:
+                response = make_response(method(*args, **kwargs))
+            except Exception:
+                self.store.release(key)
+                raise
+            if 200 <= response.status_code < 300:
+                self.store.complete(key, fingerprint, {
+                    'status': response.status_code,
+                    'body': response.get_data(as_text=True),
+                    'mimetype': response.mimetype
+                }, self.ttl)
+            else:
+                self.store.release(key)
+            return response
+        return wrapper
+
+
+def create_idempotency_store(name, path, max_entries):
+    """Build the store named by IDEMPOTENCY_BACKEND ('memory' or 'sqlite')"""
+    if name == 'sqlite':
+        return SQLiteIdempotencyStore(path, max_entries)
+    if name == 'memory':
+        return MemoryIdempotencyStore(max_entries)
+    raise ValueError(f'Unknown idempotency backend: {name}')
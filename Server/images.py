@@ -0,0 +1,65 @@
+import os
+import re
+import uuid
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# Sizes every uploaded image is stored at, largest first: name -> bounding box in pixels
+RENDITIONS = {
+    'full': (1280, 1280),
+    'card': (480, 480),
+    'thumbnail': (160, 160),
+}
+# Rendition returned as an upload's url and stored in image/logo fields
+DEFAULT_RENDITION = 'card'
+WEBP_QUALITY = 80
+
+RENDITION_FILENAME = re.compile(rf'-({"|".join(RENDITIONS)})\.webp$')
+
+
+def is_rendition(url):
+    """Return True for URLs of files written by save_renditions"""
+    return bool(RENDITION_FILENAME.search(url))
+
+
+def rendition_urls(filenames, prefix='/uploads/'):
+    return {rendition: f'{prefix}{filename}' for rendition, filename in filenames.items()}
+
+
+def rendition_filenames(name):
+    """Return {rendition: filename} for every rendition of the image stored under name"""
+    return {rendition: f'{name}-{rendition}.webp' for rendition in RENDITIONS}
+
+
+def new_image_name():
+    return str(uuid.uuid4())
+
+
+def save_renditions(source, folder, name=None, renditions=None):
+    """Decode an image (path or file object) once and save its renditions (all when not given) as WebP in folder.
+    Returns {rendition: filename} and raises ValueError when source is not a readable image."""
+    try:
+        with Image.open(source) as original:
+            # JPEGs can decode straight at a reduced scale when far larger than the biggest rendition
+            original.draft('RGB', RENDITIONS['full'])
+            image = ImageOps.exif_transpose(original)
+            image.load()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        raise ValueError('File is not a supported image') from e
+
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+
+    name = name or new_image_name()
+    renditions = renditions or list(RENDITIONS)
+    filenames = {}
+    # Each rendition is scaled down from the previous, larger one
+    for rendition, filename in rendition_filenames(name).items():
+        image.thumbnail(RENDITIONS[rendition], Image.LANCZOS)
+        if rendition not in renditions:
+            continue
+        image.save(os.path.join(folder, filename), 'WEBP', quality=WEBP_QUALITY, method=4)
+        filenames[rendition] = filename
+        if len(filenames) == len(renditions):
+            break
+    return filenames
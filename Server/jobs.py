@@ -0,0 +1,190 @@
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from extensions import db
+
+logger = logging.getLogger(__name__)
+
+
+def utcnow():
+    """Job times are stored as naive UTC, whatever timezone the server runs in"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class JobQueue:
+    """Queue of follow-up work stored in the jobs table and run outside the request by JobWorker threads.
+
+    Enqueueing adds a row to the caller's transaction, so a job only becomes visible once the request's
+    own writes commit and disappears with them on rollback. A job's writes commit together with its
+    completion. Failures are retried with exponential backoff until the task's max_attempts is reached.
+    """
+
+    def __init__(self, model, base_delay=5, max_delay=3600, lock_timeout=300, retention=7 * 86400):
+        self.model = model
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock_timeout = lock_timeout
+        self.retention = retention
+        self.tasks = {}
+        self.schedule = {}
+        self.task('purge_jobs', every=3600)(self.purge)
+
+    def task(self, name=None, max_attempts=5, every=None):
+        """Decorator registering a function as a job. With every=<seconds> workers also run it on that interval."""
+        def decorator(function):
+            task_name = name or function.__name__
+            self.tasks[task_name] = (function, max_attempts)
+            if every:
+                self.schedule[task_name] = every
+            return function
+        return decorator
+
+    def enqueue(self, name, payload=None, delay=0, key=None):
+        """Add a job to the current transaction. payload is passed to the task as keyword arguments.
+        Nothing is added if a job with the same key already exists."""
+        if name not in self.tasks:
+            raise ValueError(f'Unknown job: {name}')
+        insert = postgresql_insert if db.engine.dialect.name == 'postgresql' else sqlite_insert
+        db.session.execute(insert(self.model).values(
+            name=name,
+            payload=payload or {},
+            key=key,
+            max_attempts=self.tasks[name][1],
+            run_at=utcnow() + timedelta(seconds=delay)
+        ).on_conflict_do_nothing(index_elements=['key']))
+
+    def schedule_due(self):
+        """Enqueue the current run of every periodic task. Runs are keyed by interval, so any number of
+        workers can call this and each run is still only queued once."""
+        slot_time = time.time()
+        for name, every in self.schedule.items():
+            self.enqueue(name, key=f'{name}:{int(slot_time // every)}')
+        db.session.commit()
+
+    def claim(self, worker_id):
+        """Lock the next due job for worker_id and return it, or None when nothing is due"""
+        model = self.model
+        now = utcnow()
+        due = db.or_(
+            db.and_(model.status == 'pending', model.run_at <= now),
+            # A job whose worker died mid-run is picked up again once its lock expires
+            db.and_(model.status == 'running', model.locked_at <= now - timedelta(seconds=self.lock_timeout))
+        )
+        query = db.select(model.id).where(due).order_by(model.run_at).limit(1)
+        if db.engine.dialect.name == 'postgresql':
+            query = query.with_for_update(skip_locked=True)
+        job_id = db.session.execute(query).scalar()
+        if job_id is None:
+            db.session.rollback()
+            return None
+
+        # The conditional update loses cleanly if another worker claimed the job first
+        claimed = db.session.execute(db.update(model).where(model.id == job_id, due).values(
+            status='running', locked_by=worker_id, locked_at=now, attempts=model.attempts + 1
+        ))
+        db.session.commit()
+        return db.session.get(model, job_id) if claimed.rowcount == 1 else None
+
+    def run(self, job):
+        """Run a claimed job and record its completion, next retry or final failure"""
+        function = self.tasks.get(job.name, (None,))[0]
+        try:
+            if function is None:
+                raise LookupError(f'No task registered as {job.name}')
+            function(**job.payload)
+        except Exception as e:
+            db.session.rollback()
+            logger.exception('Job %s (%s) failed on attempt %s', job.id, job.name, job.attempts)
+            job.last_error = f'{type(e).__name__}: {e}'[:1000]
+            if job.attempts < job.max_attempts:
+                job.status = 'pending'
+                job.run_at = utcnow() + timedelta(seconds=self.backoff(job.attempts))
+            else:
+                job.status = 'failed'
+                job.finished_at = utcnow()
+        else:
+            job.status = 'done'
+            job.finished_at = utcnow()
+        job.locked_by = None
+        db.session.commit()
+
+    def backoff(self, attempts):
+        """Seconds to wait before retrying after the given number of attempts, with jitter"""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1)
+
+    def purge(self):
+        """Delete finished jobs older than the retention period"""
+        self.model.query.filter(
+            self.model.status.in_(['done', 'failed']),
+            self.model.finished_at < utcnow() - timedelta(seconds=self.retention)
+        ).delete(synchronize_session=False)
+
+
+class JobWorker:
+    """Pool of threads that claim and run due jobs, each in its own app context"""
+
+    def __init__(self, app, queue, threads=2, poll_interval=1.0, schedule_interval=30):
+        self.app = app
+        self.queue = queue
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.schedule_interval = schedule_interval
+        self.stopping = threading.Event()
+        self.started = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start the worker threads once; later calls do nothing"""
+        with self.lock:
+            if self.started or self.threads <= 0:
+                return
+            for index in range(self.threads):
+                thread = threading.Thread(target=self.loop, args=(index,), name=f'job-worker-{index}', daemon=True)
+                thread.start()
+                self.started.append(thread)
+
+    def stop(self, timeout=None):
+        self.stopping.set()
+        for thread in self.started:
+            thread.join(timeout)
+
+    def loop(self, index):
+        worker_id = f'{socket.gethostname()}:{os.getpid()}:{index}'
+        next_schedule = 0
+        while not self.stopping.is_set():
+            job = None
+            with self.app.app_context():
+                try:
+                    # One thread per process keeps periodic tasks queued
+                    if index == 0 and time.monotonic() >= next_schedule:
+                        self.queue.schedule_due()
+                        next_schedule = time.monotonic() + self.schedule_interval
+                    job = self.queue.claim(worker_id)
+                    if job is not None:
+                        self.queue.run(job)
+                except Exception:
+                    logger.exception('Job worker %s failed', worker_id)
+                    db.session.rollback()
+            # Go straight on to the next job while there is work, otherwise wait for new jobs
+            if job is None:
+                self.stopping.wait(self.poll_interval)
+
+    def run_until_empty(self):
+        """Run due jobs in the calling thread until none are left, returning how many ran"""
+        worker_id = f'{socket.gethostname()}:{os.getpid()}:burst'
+        count = 0
+        with self.app.app_context():
+            self.queue.schedule_due()
+            while (job := self.queue.claim(worker_id)) is not None:
+                self.queue.run(job)
+                count += 1
+        return count
@@ -0,0 +1,54 @@
+"""add lookup indexes
+
+Revision ID: 8f3a1c2d9b47
+Revises: 675c5f44e19b
+Create Date: 2026-10-18 09:12:41.308215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8f3a1c2d9b47'
+down_revision = '675c5f44e19b'
+branch_labels = None
+depends_on = None
+
+
+# (name, table, columns, partial index condition)
+INDEXES = [
+    ('ix_orders_restaurant_id_created_at', 'orders', ['restaurant_id', 'created_at'], None),
+    ('ix_orders_customer_id_created_at', 'orders', ['customer_id', 'created_at'], None),
+    ('ix_orders_delivery_agent_id_delivery_time', 'orders', ['delivery_agent_id', 'delivery_time'], None),
+    ('ix_orders_pending_delivery_agent_id', 'orders', ['delivery_agent_id'], 'delivery_time IS NULL'),
+    ('ix_order_menu_items_order_id', 'order_menu_items', ['order_id'], None),
+    ('ix_order_menu_items_menu_item_id', 'order_menu_items', ['menu_item_id'], None),
+    ('ix_payments_restaurant_id_created_at', 'payments', ['restaurant_id', 'created_at'], None),
+    ('ix_payments_customer_id_created_at', 'payments', ['customer_id', 'created_at'], None),
+    ('ix_menu_items_restaurant_id_availability', 'menu_items', ['restaurant_id', 'availability'], None),
+    ('ix_delivery_agents_restaurant_id', 'delivery_agents', ['restaurant_id'], None),
+    ('ix_restaurant_reviews_restaurant_id', 'restaurant_reviews', ['restaurant_id'], None),
+    ('ix_restaurant_reviews_customer_id', 'restaurant_reviews', ['customer_id'], None),
+    ('ix_delivery_reviews_delivery_agent_id', 'delivery_reviews', ['delivery_agent_id'], None),
+    ('ix_delivery_reviews_customer_id', 'delivery_reviews', ['customer_id'], None),
+]
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction on Postgres,
+    # so build the indexes in autocommit mode to avoid locking writes
+    with op.get_context().autocommit_block():
+        for name, table, columns, where in INDEXES:
+            op.create_index(
+                name, table, columns,
+                postgresql_concurrently=True,
+                postgresql_where=sa.text(where) if where else None,
+                sqlite_where=sa.text(where) if where else None
+            )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns, where in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
@@ -0,0 +1,49 @@
+"""add stk requests
+
+Revision ID: a4e9c7f3b218
+Revises: f2b6d8e41c07
+Create Date: 2026-10-18 17:27:24.702628
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4e9c7f3b218'
+down_revision = 'f2b6d8e41c07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('stk_requests',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('checkout_request_id', sa.String(), nullable=False),
+    sa.Column('merchant_request_id', sa.String(), nullable=True),
+    sa.Column('order_id', sa.Integer(), nullable=False),
+    sa.Column('customer_id', sa.Integer(), nullable=False),
+    sa.Column('phone', sa.String(), nullable=False),
+    sa.Column('amount', sa.Float(), nullable=False),
+    sa.Column('status', sa.String(), server_default='pending', nullable=False),
+    sa.Column('result_code', sa.Integer(), nullable=True),
+    sa.Column('result_desc', sa.String(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('checked_at', sa.DateTime(), nullable=True),
+    sa.Column('settled_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['customer_id'], ['customers.id'], name=op.f('fk_stk_requests_customer_id_customers')),
+    sa.ForeignKeyConstraint(['order_id'], ['orders.id'], name=op.f('fk_stk_requests_order_id_orders'), ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('checkout_request_id', name=op.f('uq_stk_requests_checkout_request_id'))
+    )
+    with op.batch_alter_table('stk_requests', schema=None) as batch_op:
+        batch_op.create_index('ix_stk_requests_order_id_status', ['order_id', 'status'], unique=False)
+        batch_op.create_index('ix_stk_requests_status_created_at', ['status', 'created_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('stk_requests', schema=None) as batch_op:
+        batch_op.drop_index('ix_stk_requests_status_created_at')
+        batch_op.drop_index('ix_stk_requests_order_id_status')
+
+    op.drop_table('stk_requests')
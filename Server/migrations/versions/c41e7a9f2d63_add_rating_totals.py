@@ -0,0 +1,47 @@
+"""add rating totals
+
+Revision ID: c41e7a9f2d63
+Revises: 8f3a1c2d9b47
+Create Date: 2026-10-18 10:03:27.915402
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41e7a9f2d63'
+down_revision = '8f3a1c2d9b47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('restaurants', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('rating_sum', sa.Float(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('rating_count', sa.Integer(), server_default='0', nullable=False))
+
+    with op.batch_alter_table('delivery_agents', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('rating_sum', sa.Float(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('rating_count', sa.Integer(), server_default='0', nullable=False))
+
+    # Backfill the totals from existing reviews
+    for table, review_table, foreign_key in (
+        ('restaurants', 'restaurant_reviews', 'restaurant_id'),
+        ('delivery_agents', 'delivery_reviews', 'delivery_agent_id'),
+    ):
+        op.execute(f"""
+            UPDATE {table} SET
+                rating_sum = COALESCE((SELECT SUM(r.rating) FROM {review_table} r WHERE r.{foreign_key} = {table}.id), 0),
+                rating_count = (SELECT COUNT(r.id) FROM {review_table} r WHERE r.{foreign_key} = {table}.id)
+        """)
+
+
+def downgrade():
+    with op.batch_alter_table('delivery_agents', schema=None) as batch_op:
+        batch_op.drop_column('rating_count')
+        batch_op.drop_column('rating_sum')
+
+    with op.batch_alter_table('restaurants', schema=None) as batch_op:
+        batch_op.drop_column('rating_count')
+        batch_op.drop_column('rating_sum')
@@ -0,0 +1,36 @@
+"""add restaurant daily stats
+
+Revision ID: d7b2e4f1a958
+Revises: c41e7a9f2d63
+Create Date: 2026-10-18 14:26:51.604317
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7b2e4f1a958'
+down_revision = 'c41e7a9f2d63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Fill the table afterwards with `flask rebuild-daily-stats`
+    op.create_table('restaurant_daily_stats',
+    sa.Column('restaurant_id', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('order_count', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('items_sold', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('paid_order_count', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('revenue', sa.Float(), server_default='0', nullable=False),
+    sa.Column('delivered_count', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('delivery_seconds', sa.Float(), server_default='0', nullable=False),
+    sa.ForeignKeyConstraint(['restaurant_id'], ['restaurants.id'], name=op.f('fk_restaurant_daily_stats_restaurant_id_restaurants')),
+    sa.PrimaryKeyConstraint('restaurant_id', 'day')
+    )
+
+
+def downgrade():
+    op.drop_table('restaurant_daily_stats')
@@ -0,0 +1,50 @@
+"""add mpesa callback inbox
+
+Revision ID: f2b6d8e41c07
+Revises: e5a9c3b71f20
+Create Date: 2026-10-18 17:25:38.192160
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2b6d8e41c07'
+down_revision = 'e5a9c3b71f20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('mpesa_callbacks',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('checkout_request_id', sa.String(), nullable=False),
+    sa.Column('receipt_number', sa.String(), nullable=True),
+    sa.Column('result_code', sa.Integer(), nullable=False),
+    sa.Column('payload', sa.JSON(), nullable=False),
+    sa.Column('status', sa.String(), server_default='pending', nullable=False),
+    sa.Column('note', sa.String(), nullable=True),
+    sa.Column('received_at', sa.DateTime(), nullable=False),
+    sa.Column('processed_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('checkout_request_id', name=op.f('uq_mpesa_callbacks_checkout_request_id')),
+    sa.UniqueConstraint('receipt_number', name=op.f('uq_mpesa_callbacks_receipt_number'))
+    )
+    with op.batch_alter_table('mpesa_callbacks', schema=None) as batch_op:
+        batch_op.create_index('ix_mpesa_callbacks_status_id', ['status', 'id'], unique=False)
+
+    with op.batch_alter_table('payments', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('transaction_id', sa.String(), nullable=True))
+        batch_op.create_unique_constraint(batch_op.f('uq_payments_transaction_id'), ['transaction_id'])
+
+
+def downgrade():
+    with op.batch_alter_table('payments', schema=None) as batch_op:
+        batch_op.drop_constraint(batch_op.f('uq_payments_transaction_id'), type_='unique')
+        batch_op.drop_column('transaction_id')
+
+    with op.batch_alter_table('mpesa_callbacks', schema=None) as batch_op:
+        batch_op.drop_index('ix_mpesa_callbacks_status_id')
+
+    op.drop_table('mpesa_callbacks')
@@ -3,10 +3,21 @@ from datetime import datetime
 import pytz
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.ext.associationproxy import association_proxy
+from serialization import serializer
+from jobs import utcnow
+
+
+def nairobi_now():
+    """Timestamps are stored as naive Africa/Nairobi wall-clock times, so the stored value never depends on the database session's timezone"""
+    return datetime.now(pytz.timezone('Africa/Nairobi')).replace(tzinfo=None)
 
 # Association object for orders and menu items with quantity
 class OrderMenuItem(db.Model):
     __tablename__ = 'order_menu_items'
+    __table_args__ = (
+        db.Index('ix_order_menu_items_order_id', 'order_id'),
+        db.Index('ix_order_menu_items_menu_item_id', 'menu_item_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), nullable=False)
     menu_item_id = db.Column(db.Integer, db.ForeignKey('menu_items.id'), nullable=False)
@@ -15,13 +26,7 @@ class OrderMenuItem(db.Model):
     order = db.relationship('Order', back_populates='order_menu_items')
     menu_item = db.relationship('MenuItem', back_populates='order_menu_items')
     
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'order_id': self.order_id,
-            'menu_item_id': self.menu_item_id,
-            'quantity': self.quantity
-        }
+    to_dict = serializer('id', 'order_id', 'menu_item_id', 'quantity')
 
 class Admin(db.Model):
     __tablename__ = 'admins'
@@ -66,6 +71,8 @@ class Restaurant(db.Model):
     bio= db.Column(db.String, nullable=True)
     _password_hash= db.Column(db.String, nullable=False)
     rating= db.Column(db.Float, default=3.0)
+    rating_sum= db.Column(db.Float, nullable=False, default=0, server_default='0')
+    rating_count= db.Column(db.Integer, nullable=False, default=0, server_default='0')
     admin_id= db.Column(db.Integer, db.ForeignKey('admins.id'))
     
     admin = db.relationship('Admin', back_populates='restaurants')
@@ -74,6 +81,7 @@ class Restaurant(db.Model):
     agents = db.relationship('DeliveryAgent', back_populates='restaurant')
     menu_items = db.relationship('MenuItem', back_populates='restaurant')
     restaurant_reviews = db.relationship('RestaurantReview', back_populates='restaurant')
+    daily_stats = db.relationship('RestaurantDailyStats', back_populates='restaurant', cascade='all, delete-orphan')
     
     @hybrid_property
     def password_hash(self):
@@ -86,19 +94,9 @@ class Restaurant(db.Model):
     def authenticate(self, password):
         return bcrypt.check_password_hash(self._password_hash, password.encode('utf-8'))
     
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'email': self.email,
-            'address': self.address,
-            'contact': self.contact,
-            'logo': self.logo,
-            'paybill_number': self.paybill_number,
-            'bio': self.bio,
-            'rating': self.rating,
-            'admin_id': self.admin_id
-        }
+    to_dict = serializer(
+        'id', 'name', 'email', 'address', 'contact', 'logo', 'paybill_number', 'bio', 'rating', 'admin_id'
+    )
     
     def __repr__(self):
         return f'<Restaurant {self.id} {self.name}>'  
@@ -106,11 +104,16 @@ class Restaurant(db.Model):
  
 class DeliveryAgent(db.Model):
     __tablename__ = 'delivery_agents'
+    __table_args__ = (
+        db.Index('ix_delivery_agents_restaurant_id', 'restaurant_id'),
+    )
     id= db.Column(db.Integer, primary_key=True)
     name= db.Column(db.String, nullable=False)
     contact= db.Column(db.String, nullable=False)
     image= db.Column(db.String, nullable=True)
     rating= db.Column(db.Float, default=5.0)
+    rating_sum= db.Column(db.Float, nullable=False, default=0, server_default='0')
+    rating_count= db.Column(db.Integer, nullable=False, default=0, server_default='0')
     _password_hash= db.Column(db.String, nullable=False)
     restaurant_id= db.Column(db.Integer, db.ForeignKey('restaurants.id'))
     email= db.Column(db.String, unique=True, nullable=False)
@@ -131,16 +134,7 @@ class DeliveryAgent(db.Model):
     def authenticate(self, password):
         return bcrypt.check_password_hash(self._password_hash, password.encode('utf-8'))
 
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'email': self.email,
-            'contact': self.contact,
-            'image': self.image,
-            'rating': self.rating,
-            'restaurant_id': self.restaurant_id
-        }
+    to_dict = serializer('id', 'name', 'email', 'contact', 'image', 'rating', 'restaurant_id')
 
     def __repr__(self):
         return f'<DeliveryAgent {self.id} {self.name}>'   
@@ -148,10 +142,14 @@ class DeliveryAgent(db.Model):
 
 class DeliveryReview(db.Model):
     __tablename__= 'delivery_reviews'
+    __table_args__ = (
+        db.Index('ix_delivery_reviews_delivery_agent_id', 'delivery_agent_id'),
+        db.Index('ix_delivery_reviews_customer_id', 'customer_id'),
+    )
     id= db.Column(db.Integer, primary_key=True)
     comment= db.Column(db.String, nullable=False)
     rating= db.Column(db.Float, nullable=False)
-    created_at= db.Column(db.DateTime, default=lambda: datetime.now(pytz.timezone('Africa/Nairobi')))
+    created_at= db.Column(db.DateTime, default=nairobi_now)
     delivery_agent_id= db.Column(db.Integer, db.ForeignKey('delivery_agents.id'))
     customer_id= db.Column(db.Integer, db.ForeignKey('customers.id'))
     
@@ -159,15 +157,7 @@ class DeliveryReview(db.Model):
     delivery_agent = db.relationship('DeliveryAgent', back_populates='delivery_reviews')
     customer = db.relationship('Customer', back_populates='delivery_reviews')
     
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'comment': self.comment,
-            'rating': self.rating,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'delivery_agent_id': self.delivery_agent_id,
-            'customer_id': self.customer_id
-        }
+    to_dict = serializer('id', 'comment', 'rating', 'created_at', 'delivery_agent_id', 'customer_id')
     
     def __repr__(self):
         return f'<DeliveryReview {self.id} {self.comment}>'
@@ -175,25 +165,21 @@ class DeliveryReview(db.Model):
 
 class RestaurantReview(db.Model):
     __tablename__= 'restaurant_reviews'
+    __table_args__ = (
+        db.Index('ix_restaurant_reviews_restaurant_id', 'restaurant_id'),
+        db.Index('ix_restaurant_reviews_customer_id', 'customer_id'),
+    )
     id= db.Column(db.Integer, primary_key=True)
     comment= db.Column(db.String, nullable=False)
     rating= db.Column(db.Float, nullable=False)
-    created_at= db.Column(db.DateTime, default=lambda: datetime.now(pytz.timezone('Africa/Nairobi')))
+    created_at= db.Column(db.DateTime, default=nairobi_now)
     restaurant_id= db.Column(db.Integer, db.ForeignKey('restaurants.id'))
     customer_id= db.Column(db.Integer, db.ForeignKey('customers.id'))
     
     restaurant = db.relationship('Restaurant', back_populates='restaurant_reviews')
     customer = db.relationship('Customer', back_populates='restaurant_reviews')
     
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'comment': self.comment,
-            'rating': self.rating,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'restaurant_id': self.restaurant_id,
-            'customer_id': self.customer_id
-        }
+    to_dict = serializer('id', 'comment', 'rating', 'created_at', 'restaurant_id', 'customer_id')
     
     def __repr__(self):
         return f'<RestaurantReview {self.id} {self.comment}>'
@@ -201,6 +187,9 @@ class RestaurantReview(db.Model):
 
 class MenuItem(db.Model):
     __tablename__= 'menu_items'
+    __table_args__ = (
+        db.Index('ix_menu_items_restaurant_id_availability', 'restaurant_id', 'availability'),
+    )
     id= db.Column(db.Integer, primary_key=True)
     name= db.Column(db.String, nullable=False)
     unit_price= db.Column(db.Float, nullable=False)
@@ -212,24 +201,24 @@ class MenuItem(db.Model):
     restaurant = db.relationship('Restaurant', back_populates='menu_items')
     order_menu_items = db.relationship('OrderMenuItem', back_populates='menu_item')
 
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'unit_price': self.unit_price,
-            'image': self.image,
-            'description': self.description,
-            'availability': self.availability,
-            'restaurant_id': self.restaurant_id
-        }
+    to_dict = serializer('id', 'name', 'unit_price', 'image', 'description', 'availability', 'restaurant_id')
 
     def __repr__(self):
         return f'<MenuItem {self.id} {self.name}>'
 
 class Order(db.Model):
     __tablename__="orders"
+    __table_args__ = (
+        db.Index('ix_orders_restaurant_id_created_at', 'restaurant_id', 'created_at'),
+        db.Index('ix_orders_customer_id_created_at', 'customer_id', 'created_at'),
+        db.Index('ix_orders_delivery_agent_id_delivery_time', 'delivery_agent_id', 'delivery_time'),
+        # Agents' pending queue only ever looks at undelivered orders
+        db.Index('ix_orders_pending_delivery_agent_id', 'delivery_agent_id',
+                 postgresql_where=db.text('delivery_time IS NULL'),
+                 sqlite_where=db.text('delivery_time IS NULL')),
+    )
     id= db.Column(db.Integer, primary_key=True)
-    created_at= db.Column(db.DateTime, default=lambda: datetime.now(pytz.timezone('Africa/Nairobi')))
+    created_at= db.Column(db.DateTime, default=nairobi_now)
     delivery_time= db.Column(db.DateTime, nullable=True)
     delivery_address= db.Column(db.String, nullable=False)
     payment_status= db.Column(db.Boolean, default=False)
@@ -244,18 +233,10 @@ class Order(db.Model):
     customer = db.relationship('Customer', back_populates='orders')
     payment = db.relationship('Payment', back_populates='order', uselist=False)
     
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'delivery_time': self.delivery_time.isoformat() if self.delivery_time else None,
-            'delivery_address': self.delivery_address,
-            'payment_status': self.payment_status,
-            'total_price': self.total_price,
-            'restaurant_id': self.restaurant_id,
-            'delivery_agent_id': self.delivery_agent_id,
-            'customer_id': self.customer_id
-        }
+    to_dict = serializer(
+        'id', 'created_at', 'delivery_time', 'delivery_address', 'payment_status', 'total_price',
+        'restaurant_id', 'delivery_agent_id', 'customer_id'
+    )
     
     def __repr__(self):
         return f'<Order {self.id} {self.created_at}>'
@@ -286,44 +267,143 @@ class Customer(db.Model):
     def authenticate(self, password):
         return bcrypt.check_password_hash(self._password_hash, password.encode('utf-8'))
 
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'email': self.email,
-            'contact': self.contact,
-            'image': self.image
-        }
+    to_dict = serializer('id', 'name', 'email', 'contact', 'image')
 
     def __repr__(self):
         return f'<Customer {self.id} {self.name}>'
 
 class Payment(db.Model):
     __tablename__= 'payments'
+    __table_args__ = (
+        db.Index('ix_payments_restaurant_id_created_at', 'restaurant_id', 'created_at'),
+        db.Index('ix_payments_customer_id_created_at', 'customer_id', 'created_at'),
+    )
     id= db.Column(db.Integer, primary_key=True)
     amount= db.Column(db.Float, nullable=False)
-    created_at= db.Column(db.DateTime, default=lambda: datetime.now(pytz.timezone('Africa/Nairobi')))
+    created_at= db.Column(db.DateTime, default=nairobi_now)
     method= db.Column(db.String, nullable=False)
     restaurant_id= db.Column(db.Integer, db.ForeignKey('restaurants.id'))
     order_id= db.Column(db.Integer, db.ForeignKey('orders.id'), unique=True)
     customer_id= db.Column(db.Integer, db.ForeignKey('customers.id'))
+    # M-Pesa receipt number for mobile money payments
+    transaction_id= db.Column(db.String, unique=True, nullable=True)
     
     restaurant = db.relationship('Restaurant', back_populates='payments')
     order = db.relationship('Order', back_populates='payment')
     customer = db.relationship('Customer', back_populates='payments')
   
+    to_dict = serializer('id', 'amount', 'created_at', 'method', 'restaurant_id', 'order_id', 'customer_id')
+    
+    def __repr__(self):
+        return f'<Payment {self.id} {self.amount}>'
+
+    
+
+
+# Daily rollup per restaurant, kept up to date as orders are placed, paid and delivered
+class RestaurantDailyStats(db.Model):
+    __tablename__ = 'restaurant_daily_stats'
+    restaurant_id= db.Column(db.Integer, db.ForeignKey('restaurants.id'), primary_key=True)
+    day= db.Column(db.Date, primary_key=True)
+    # Orders placed that day and the quantity of menu items on them
+    order_count= db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    items_sold= db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Payments received that day
+    paid_order_count= db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    revenue= db.Column(db.Float, nullable=False, default=0, server_default='0')
+    # Orders delivered that day and their total time from order to delivery
+    delivered_count= db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    delivery_seconds= db.Column(db.Float, nullable=False, default=0, server_default='0')
+    
+    restaurant = db.relationship('Restaurant', back_populates='daily_stats')
+    
     def to_dict(self):
         return {
-            'id': self.id,
-            'amount': self.amount,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'method': self.method,
-            'restaurant_id': self.restaurant_id,
-            'order_id': self.order_id,
-            'customer_id': self.customer_id
+            'day': self.day.isoformat(),
+            'order_count': self.order_count,
+            'items_sold': self.items_sold,
+            'paid_order_count': self.paid_order_count,
+            'revenue': round(self.revenue, 2),
+            'delivered_count': self.delivered_count,
+            'avg_delivery_minutes': round(self.delivery_seconds / self.delivered_count / 60, 1) if self.delivered_count else None
         }
     
     def __repr__(self):
-        return f'<Payment {self.id} {self.amount}>'
+        return f'<RestaurantDailyStats {self.restaurant_id} {self.day}>'
+
 
-    
\ No newline at end of file
+# Follow-up work queued by request handlers and run by the job worker (see jobs.py)
+class Job(db.Model):
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+    id= db.Column(db.Integer, primary_key=True)
+    name= db.Column(db.String, nullable=False)
+    payload= db.Column(db.JSON, nullable=False, default=dict)
+    # Optional deduplication key, a job with a key that is already queued is not added again
+    key= db.Column(db.String, unique=True, nullable=True)
+    # pending -> running -> done, or back to pending for a retry, or failed after max_attempts
+    status= db.Column(db.String, nullable=False, default='pending', server_default='pending')
+    attempts= db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    max_attempts= db.Column(db.Integer, nullable=False, default=5, server_default='5')
+    last_error= db.Column(db.Text, nullable=True)
+    # Times are naive UTC
+    run_at= db.Column(db.DateTime, nullable=False, default=utcnow)
+    locked_at= db.Column(db.DateTime, nullable=True)
+    locked_by= db.Column(db.String, nullable=True)
+    created_at= db.Column(db.DateTime, nullable=False, default=utcnow)
+    finished_at= db.Column(db.DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<Job {self.id} {self.name} {self.status}>'
+
+
+# Raw M-Pesa STK callbacks, stored as received and applied to orders and payments by a background job
+class MpesaCallbackEntry(db.Model):
+    __tablename__ = 'mpesa_callbacks'
+    __table_args__ = (
+        db.Index('ix_mpesa_callbacks_status_id', 'status', 'id'),
+    )
+    id= db.Column(db.Integer, primary_key=True)
+    # Safaricom resends a callback until it is acknowledged, these keys make the copies no-ops
+    checkout_request_id= db.Column(db.String, unique=True, nullable=False)
+    receipt_number= db.Column(db.String, unique=True, nullable=True)
+    result_code= db.Column(db.Integer, nullable=False)
+    payload= db.Column(db.JSON, nullable=False)
+    # pending -> paid, failed (payment cancelled or declined) or ignored (nothing to settle)
+    status= db.Column(db.String, nullable=False, default='pending', server_default='pending')
+    note= db.Column(db.String, nullable=True)
+    # Times are naive UTC
+    received_at= db.Column(db.DateTime, nullable=False, default=utcnow)
+    processed_at= db.Column(db.DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<MpesaCallbackEntry {self.id} {self.checkout_request_id} {self.status}>'
+
+
+# STK push prompts sent to customers, tracked until a callback or the reconciler settles them
+class StkRequest(db.Model):
+    __tablename__ = 'stk_requests'
+    __table_args__ = (
+        db.Index('ix_stk_requests_status_created_at', 'status', 'created_at'),
+        db.Index('ix_stk_requests_order_id_status', 'order_id', 'status'),
+    )
+    id= db.Column(db.Integer, primary_key=True)
+    checkout_request_id= db.Column(db.String, unique=True, nullable=False)
+    merchant_request_id= db.Column(db.String, nullable=True)
+    order_id= db.Column(db.Integer, db.ForeignKey('orders.id', ondelete='CASCADE'), nullable=False)
+    customer_id= db.Column(db.Integer, db.ForeignKey('customers.id'), nullable=False)
+    phone= db.Column(db.String, nullable=False)
+    amount= db.Column(db.Float, nullable=False)
+    # pending -> paid, failed (cancelled or declined) or expired (no outcome from Safaricom in time)
+    status= db.Column(db.String, nullable=False, default='pending', server_default='pending')
+    result_code= db.Column(db.Integer, nullable=True)
+    result_desc= db.Column(db.String, nullable=True)
+    # Times are naive UTC
+    created_at= db.Column(db.DateTime, nullable=False, default=utcnow)
+    checked_at= db.Column(db.DateTime, nullable=True)
+    settled_at= db.Column(db.DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<StkRequest {self.id} {self.checkout_request_id} {self.status}>'
@@ -1,4 +1,4 @@
-from app import app, db
+from app import app, db, rebuild_ratings, rebuild_daily_stats
 from models import Restaurant, DeliveryAgent, Customer, MenuItem, Order, Payment, RestaurantReview, DeliveryReview, Admin, OrderMenuItem
 from faker import Faker
 import random
@@ -368,6 +368,11 @@ def seed_data():
             db.session.add(review)
         
         db.session.commit()
+        
+        # Derive rating totals and averages from the seeded reviews
+        rebuild_ratings()
+        # Build the dashboard rollup from the seeded orders and payments
+        rebuild_daily_stats()
         print("Database seeded successfully!")
 
 if __name__ == "__main__":
@@ -0,0 +1,95 @@
+import os
+import sys
+import tempfile
+
+import pytest
+from sqlalchemy import event
+
+# Point the app at a throwaway SQLite database (shared by request threads) before it is imported
+DATABASE_DIR = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(DATABASE_DIR, 'test.db')}"
+os.environ['JOBS_WORKER_THREADS'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app as flask_app  # noqa: E402
+from extensions import db  # noqa: E402
+from models import Admin, Customer, DeliveryAgent, MenuItem, Order, OrderMenuItem, Restaurant  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    with flask_app.app_context():
+        db.create_all()
+        yield flask_app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def client_as(app):
+    """Return a function building a test client logged in as the given user"""
+    def make_client(user_type, user_id):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['user_type'] = user_type
+            session['user_id'] = user_id
+        return client
+    return make_client
+
+
+@pytest.fixture
+def shop(app):
+    """A restaurant with a menu, a delivery agent and a customer"""
+    admin = Admin(name='Admin', email='admin@example.com')
+    admin.password_hash = 'password'
+    db.session.add(admin)
+    db.session.flush()
+    restaurant = Restaurant(name='Cafe', email='cafe@example.com', address='Nairobi', contact='0700000000', admin_id=admin.id)
+    restaurant.password_hash = 'password'
+    customer = Customer(name='Customer', email='customer@example.com', contact='0711111111')
+    customer.password_hash = 'password'
+    db.session.add_all([restaurant, customer])
+    db.session.flush()
+    agent = DeliveryAgent(name='Agent', email='agent@example.com', contact='0722222222', restaurant_id=restaurant.id)
+    agent.password_hash = 'password'
+    db.session.add(agent)
+    db.session.add_all([
+        MenuItem(name=f'Dish {n}', unit_price=100.0 * n, restaurant_id=restaurant.id) for n in range(1, 4)
+    ])
+    db.session.commit()
+    return {'restaurant_id': restaurant.id, 'customer_id': customer.id, 'agent_id': agent.id}
+
+
+@pytest.fixture
+def add_orders(shop):
+    """Return a function adding n unpaid orders, each with two menu items, for the shop's customer"""
+    def create(n):
+        menu_items = MenuItem.query.filter_by(restaurant_id=shop['restaurant_id']).limit(2).all()
+        orders = []
+        for _ in range(n):
+            order = Order(
+                restaurant_id=shop['restaurant_id'],
+                customer_id=shop['customer_id'],
+                delivery_agent_id=shop['agent_id'],
+                delivery_address='Nairobi',
+                total_price=sum(item.unit_price for item in menu_items)
+            )
+            order.order_menu_items = [OrderMenuItem(menu_item_id=item.id, quantity=1) for item in menu_items]
+            orders.append(order)
+        db.session.add_all(orders)
+        db.session.commit()
+        return [order.id for order in orders]
+    return create
+
+
+@pytest.fixture
+def queries(app):
+    """List of the SQL statements executed while the test runs"""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    yield statements
+    event.remove(db.engine, 'before_cursor_execute', record)
@@ -0,0 +1,64 @@
+from datetime import date, datetime, timedelta, timezone
+
+from app import adjust_order_stats, rebuild_daily_stats
+from extensions import db
+from models import MenuItem, Order, OrderMenuItem, RestaurantDailyStats
+
+
+def rollup():
+    """The rollup rows as comparable tuples"""
+    return sorted(
+        (row.restaurant_id, row.day, row.order_count, row.items_sold, row.paid_order_count,
+         round(row.revenue, 2), row.delivered_count, round(row.delivery_seconds, 2))
+        for row in RestaurantDailyStats.query
+    )
+
+
+def test_rebuild_matches_incremental_rollup(client_as, shop):
+    customer = client_as('customer', shop['customer_id'])
+    agent = client_as('agent', shop['agent_id'])
+    menu_item = MenuItem.query.filter_by(restaurant_id=shop['restaurant_id']).first()
+
+    # Orders placed, paid and delivered now through the API
+    order_ids = []
+    for quantity in (1, 2):
+        response = customer.post('/api/customer/orders', json={
+            'restaurant_id': shop['restaurant_id'],
+            'delivery_address': 'Nairobi',
+            'menu_items': [{'id': menu_item.id, 'quantity': quantity}]
+        })
+        assert response.status_code == 201
+        order_ids.append(response.get_json()['id'])
+    response = customer.post('/api/customer/payments', json={'order_id': order_ids[0], 'amount': 100, 'method': 'cash'})
+    assert response.status_code == 201
+    db.session.get(Order, order_ids[1]).delivery_agent_id = shop['agent_id']
+    db.session.commit()
+    delivered_at = datetime.now(timezone.utc) + timedelta(minutes=20)
+    response = agent.patch(f'/api/agent/orders/{order_ids[1]}', json={'delivery_time': delivered_at.isoformat().replace('+00:00', 'Z')})
+    assert response.status_code == 200
+
+    # An order placed at 01:00 Nairobi time and delivered 30 minutes later, at 22:30 UTC the day before
+    order = Order(
+        restaurant_id=shop['restaurant_id'],
+        customer_id=shop['customer_id'],
+        delivery_agent_id=shop['agent_id'],
+        delivery_address='Nairobi',
+        total_price=menu_item.unit_price,
+        created_at=datetime(2026, 3, 2, 1, 0)
+    )
+    order.order_menu_items = [OrderMenuItem(menu_item_id=menu_item.id, quantity=1)]
+    db.session.add(order)
+    db.session.flush()
+    adjust_order_stats(order, 1)
+    db.session.commit()
+    response = agent.patch(f'/api/agent/orders/{order.id}', json={'delivery_time': '2026-03-01T22:30:00.000Z'})
+    assert response.status_code == 200
+    assert db.session.get(Order, order.id).delivery_time == datetime(2026, 3, 2, 1, 30)
+
+    day = db.session.get(RestaurantDailyStats, (shop['restaurant_id'], date(2026, 3, 2)))
+    assert (day.order_count, day.delivered_count, day.delivery_seconds) == (1, 1, 1800)
+
+    incremental = rollup()
+    rebuild_daily_stats()
+    db.session.expire_all()
+    assert rollup() == incremental
@@ -0,0 +1,29 @@
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from extensions import db
+from models import Order, Payment
+
+THREADS = 16
+ATTEMPTS = 64
+
+
+def test_parallel_payments_settle_an_order_once(app, client_as, shop, add_orders):
+    order_id = add_orders(1)[0]
+
+    def pay(_):
+        client = client_as('customer', shop['customer_id'])
+        response = client.post('/api/customer/payments', json={'order_id': order_id, 'amount': 300, 'method': 'cash'})
+        return response.status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(THREADS) as pool:
+        statuses = Counter(pool.map(pay, range(ATTEMPTS)))
+    elapsed = time.perf_counter() - started
+    print(f'{ATTEMPTS} settlements on {THREADS} threads: {ATTEMPTS / elapsed:.0f} requests/s')
+
+    # Exactly one request pays; the others get a clean "already paid" instead of a constraint error
+    assert statuses == {201: 1, 400: ATTEMPTS - 1}
+    assert Payment.query.filter_by(order_id=order_id).count() == 1
+    assert db.session.get(Order, order_id).payment_status is True
@@ -0,0 +1,22 @@
+import pytest
+
+
+# GET /api/restaurant/orders runs one query for the orders plus one for their line items when
+# menu_items are embedded, however many orders there are
+@pytest.mark.parametrize('query_string, expected_queries', [
+    ('', 2),
+    ('?limit=10', 2),
+    ('?include=customer,delivery_agent,menu_items', 2),
+    ('?include=&fields=id,total_price', 1),
+])
+def test_restaurant_orders_query_count_does_not_grow_with_orders(client_as, shop, add_orders, queries, query_string, expected_queries):
+    client = client_as('restaurant', shop['restaurant_id'])
+    counts = []
+    for n in (3, 30):
+        add_orders(n)
+        queries.clear()
+        response = client.get(f'/api/restaurant/orders{query_string}')
+        assert response.status_code == 200
+        counts.append(len(queries))
+
+    assert counts == [expected_queries, expected_queries]
@@ -0,0 +1,35 @@
+from datetime import timedelta
+
+import app as server
+from extensions import db
+from jobs import utcnow
+from models import Order, StkRequest
+
+
+def test_reconcile_settles_paid_pushes_and_survives_deleted_orders(monkeypatch, shop, add_orders):
+    monkeypatch.setattr(server.daraja, 'shortcode', '174379')
+    monkeypatch.setattr(server.daraja, 'consumer_key', 'key')
+    monkeypatch.setattr(server.daraja, 'consumer_secret', 'secret')
+    monkeypatch.setattr(server.daraja, 'passkey', 'passkey')
+    monkeypatch.setattr(server.daraja, 'stk_query', lambda checkout_request_id: {
+        'ResultCode': '0', 'ResultDesc': 'The service request is processed successfully.'
+    })
+
+    deleted_order_id, order_id = add_orders(2)
+    sent_at = utcnow() - timedelta(seconds=server.STK_QUERY_AFTER + 30)
+    db.session.add_all([
+        StkRequest(checkout_request_id=f'ws_CO_{id}', order_id=id, customer_id=shop['customer_id'],
+                   phone='254711111111', amount=300, created_at=sent_at)
+        for id in (deleted_order_id, order_id)
+    ])
+    db.session.commit()
+    # The order is deleted after the push was sent, which SQLite does not cascade to its push
+    db.session.execute(db.delete(Order).where(Order.id == deleted_order_id))
+    db.session.commit()
+
+    server.reconcile_stk_requests()
+
+    orphan = StkRequest.query.filter_by(order_id=deleted_order_id).one()
+    assert (orphan.status, orphan.result_desc) == ('failed', 'Paid, but the order no longer exists')
+    assert StkRequest.query.filter_by(order_id=order_id).one().status == 'paid'
+    assert db.session.get(Order, order_id).payment_status is True